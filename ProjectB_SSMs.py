@@ -7,36 +7,161 @@ Original file is located at
     https://colab.research.google.com/drive/1dRFEj8B0liMAjZ_AlRKZy-dzP2t1ki_C
 """
 
-from google.colab import drive
-drive.mount('gdrive')
-
-# Paths
-data_path = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/"
-annotations_file = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/annotations.csv"
-img_dir = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/images"
-
-!pip install ptflops
+import os
+import socket
+import subprocess
+import sys
+import time
+import math
+import random
+import asyncio
+import collections
+import contextlib
+import copy
+import hashlib
+import io
+import itertools
+import json
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
-from torchvision import transforms, models
+from torch.utils.data import Dataset, DataLoader, Sampler, Subset
+from torch.utils.data.distributed import DistributedSampler
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torchvision import transforms
+from torchvision.models import resnet18, ResNet18_Weights
 import pandas as pd
 from PIL import Image
-import os
-import time
-from einops import rearrange, repeat
-from torchvision.models import resnet18, ResNet18_Weights
-import math
-from ptflops import get_model_complexity_info
-from sklearn.metrics import confusion_matrix, classification_report, precision_recall_fscore_support
-import seaborn as sns
-import matplotlib.pyplot as plt
 import numpy as np
+from module_profiler import ModuleProfiler
+from batch_transforms import BatchTransform
 
-"""Baseline Model"""
+# ptflops, sklearn, matplotlib and torch.ao.quantization are imported inside the
+# functions that use them, so importing this module stays fast and works offline.
+
+# Paths
+data_path = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/"
+annotations_file = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/annotations.csv"
+img_dir = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/images"
+
+def mount_drive():
+    """Mount Google Drive when running in Colab; no-op elsewhere."""
+    try:
+        from google.colab import drive
+    except ImportError:
+        return
+    drive.mount('gdrive')
+
+if __name__ == "__main__":
+    mount_drive()
+
+"""Pretrained weight store"""
+
+WEIGHT_STORE_DIR = os.environ.get('PROJECTB_WEIGHT_STORE',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'projectb', 'weights'))
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _verify_checksum(path, hash_prefix):
+    """Check a weight file against its sha256 prefix, caching the digest in a sidecar keyed by size and mtime
+    when the directory is writable."""
+    stat = os.stat(path)
+    sidecar = path + '.sha256'
+    fingerprint = f"{stat.st_size} {stat.st_mtime_ns}"
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            cached_fingerprint, _, digest = f.read().strip().rpartition(' ')
+        if cached_fingerprint == fingerprint:
+            return digest.startswith(hash_prefix)
+
+    digest = _sha256(path)
+    try:
+        with open(sidecar, 'w') as f:
+            f.write(f"{fingerprint} {digest}")
+    except OSError:
+        # Read-only weight stores are normal on air-gapped hosts; the digest is just not cached
+        pass
+    return digest.startswith(hash_prefix)
+
+def load_pretrained_weights(weights=ResNet18_Weights.DEFAULT, store_dir=None, allow_download=None):
+    """State dict for a torchvision weights enum, read from local storage before the network.
+
+    Lookup order: store_dir (default WEIGHT_STORE_DIR), torch hub's checkpoint cache,
+    then a download into store_dir. Every file is checked against the sha256 prefix
+    torchvision puts in the file name. Set PROJECTB_OFFLINE=1 (or allow_download=False)
+    on air-gapped machines to fail fast instead of attempting a download.
+    """
+    filename = os.path.basename(weights.url)
+    hash_prefix = torch.hub.HASH_REGEX.search(filename).group(1)
+    store_dir = store_dir or WEIGHT_STORE_DIR
+    hub_dir = os.path.join(torch.hub.get_dir(), 'checkpoints')
+
+    for directory in [store_dir, hub_dir]:
+        path = os.path.join(directory, filename)
+        if os.path.exists(path) and _verify_checksum(path, hash_prefix):
+            return torch.load(path, map_location='cpu', weights_only=True)
+
+    if allow_download is None:
+        allow_download = os.environ.get('PROJECTB_OFFLINE', '0') != '1'
+    if not allow_download:
+        raise FileNotFoundError(f"{filename} not found (or failed its checksum) in {store_dir} or {hub_dir}, "
+                                f"and downloads are disabled; copy it into {store_dir}")
+
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, filename)
+    torch.hub.download_url_to_file(weights.url, path, hash_prefix=hash_prefix)
+    return torch.load(path, map_location='cpu', weights_only=True)
+
+def pretrained_resnet18(pretrained=True):
+    """ResNet18 with ImageNet weights from the local weight store (or random init with pretrained=False)."""
+    model = resnet18(weights=None)
+    if pretrained:
+        model.load_state_dict(load_pretrained_weights(ResNet18_Weights.DEFAULT))
+    return model
+
+def measure_cold_start(model_name='HybridModel', batch_size=1):
+    """Time module import, model construction and the first forward pass in a fresh interpreter."""
+    code = f"""
+import json, time
+start = time.perf_counter()
+import torch
+import ProjectB_SSMs as m
+imported = time.perf_counter()
+model = m.MODEL_CLASSES[{model_name!r}](num_classes=2).eval()
+built = time.perf_counter()
+with torch.no_grad():
+    model(torch.randn({batch_size}, 3, 128, 128))
+done = time.perf_counter()
+print(json.dumps({{'import_s': imported - start, 'build_s': built - imported,
+                   'first_forward_s': done - built, 'total_s': done - start}}))
+"""
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    print(f"Cold start ({model_name}): import {timings['import_s']:.2f}s, build {timings['build_s']:.2f}s, "
+          f"first forward {timings['first_forward_s']:.2f}s, total {timings['total_s']:.2f}s")
+    return timings
+
+if __name__ == "__main__":
+    cold_start = measure_cold_start()
+
+
+"""MHIST data"""
+
+MHIST_CLASSES = ['SSA', 'HP']
+MHIST_MEAN = [0.485, 0.456, 0.406]
+MHIST_STD = [0.229, 0.224, 0.225]
 
 class MHISTDataset(Dataset):
     """Dataset class for MHIST data."""
@@ -58,118 +183,433 @@ class MHISTDataset(Dataset):
             image = self.transform(image)
         return image, label
 
-class BaselineModel(nn.Module):
-    """Simple ResNet18-based classification model."""
-    def __init__(self, num_classes):
-        super().__init__()
+    @property
+    def filenames(self):
+        return self.annotations.iloc[:, 0].tolist()
 
-        # Load pretrained ResNet18
-        self.resnet = resnet18(weights=ResNet18_Weights.DEFAULT)
+    @property
+    def labels(self):
+        return [self.label_map[label] for label in self.annotations.iloc[:, 1]]
 
-        # Replace the final layer
-        num_features = self.resnet.fc.in_features
-        self.resnet.fc = nn.Sequential(
-            nn.Linear(num_features, 256),
-            nn.LayerNorm(256),
-            nn.GELU(),
-            nn.Dropout(0.1),
-            nn.Linear(256, num_classes)
-        )
-
-    def forward(self, x):
-        return self.resnet(x)
-
-def train_baseline_model(annotations_file, img_dir):
-    """Train and evaluate the baseline model."""
-    # Basic transforms without augmentation
-    transform = transforms.Compose([
-        transforms.Resize((128, 128)),
+def mhist_transform(image_size=(128, 128)):
+    """Basic transforms without augmentation."""
+    return transforms.Compose([
+        transforms.Resize(image_size),
         transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        transforms.Normalize(mean=MHIST_MEAN, std=MHIST_STD)
     ])
 
-    # Create datasets and dataloaders
-    train_dataset = MHISTDataset(annotations_file, img_dir, partition='train', transform=transform)
-    test_dataset = MHISTDataset(annotations_file, img_dir, partition='test', transform=transform)
+def mhist_datasets(annotations_file, img_dir, packed_dir=None, raw=False):
+    """Train and test partitions, decoded with PIL or served from a packed store.
+
+    With raw=True items are resized uint8 (3, H, W) tensors, left for a
+    BatchTransform to convert and normalize after collation.
+    """
+    if packed_dir is None:
+        if raw:
+            transform = transforms.Compose([transforms.Resize((128, 128)), transforms.PILToTensor()])
+        else:
+            transform = mhist_transform()
+        return (MHISTDataset(annotations_file, img_dir, partition='train', transform=transform),
+                MHISTDataset(annotations_file, img_dir, partition='test', transform=transform))
+
+    datasets = []
+    for partition in ['train', 'test']:
+        if not os.path.exists(os.path.join(packed_dir, f"{partition}_images.npy")):
+            pack_mhist_partition(annotations_file, img_dir, partition, packed_dir)
+        datasets.append(PackedMHISTDataset(packed_dir, partition, transform=None if raw else packed_transform()))
+    return tuple(datasets)
+
+def mhist_batch_transform(augment=True, size=None):
+    """BatchTransform with the MHIST normalization and, if augment, flips, 90-degree
+    rotations (histology has no canonical orientation) and mild color jitter."""
+    if not augment:
+        return BatchTransform(MHIST_MEAN, MHIST_STD, size=size)
+    return BatchTransform(MHIST_MEAN, MHIST_STD, size=size, hflip=0.5, vflip=0.5, rot90=True, brightness=0.1,
+                          contrast=0.1, saturation=0.1)
+
+"""Pre-decoded MHIST image store"""
+
+def pack_mhist_partition(annotations_file, img_dir, partition, packed_dir, image_size=(128, 128)):
+    """Decode and resize a partition once into a contiguous uint8 (N, H, W, 3) memory-mapped array.
+
+    Resizing uses the same transforms.Resize on the PIL image as the training
+    transform, so after ToTensor/Normalize-equivalent ops the tensors are
+    bit-identical to the PIL path. Returns the path of the images file.
+    """
+    dataset = MHISTDataset(annotations_file, img_dir, partition=partition, transform=transforms.Resize(image_size))
+    images_path = os.path.join(packed_dir, f"{partition}_images.npy")
+    labels_path = os.path.join(packed_dir, f"{partition}_labels.npy")
+    os.makedirs(packed_dir, exist_ok=True)
+
+    tmp_path = images_path + ".tmp.npy"
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                       shape=(len(dataset), image_size[0], image_size[1], 3))
+    labels = np.empty(len(dataset), dtype=np.int64)
+    for idx in range(len(dataset)):
+        image, label = dataset[idx]
+        images[idx] = np.asarray(image, dtype=np.uint8)
+        labels[idx] = label
+    images.flush()
+    del images
+
+    np.save(labels_path, labels)
+    with open(os.path.join(packed_dir, f"{partition}_filenames.json"), 'w') as f:
+        json.dump(dataset.filenames, f)
+    os.replace(tmp_path, images_path)
+    return images_path
+
+class PackedMHISTDataset(Dataset):
+    """MHIST partition served from a pack_mhist_partition() store.
+
+    Items are zero-copy (3, H, W) uint8 views into the memory map; pass
+    packed_transform() (or any tensor transform) to get normalized float tensors.
+    """
+    def __init__(self, packed_dir, partition, transform=None):
+        # Copy-on-write mapping so torch.from_numpy gets a writable, still zero-copy array
+        self.images = np.load(os.path.join(packed_dir, f"{partition}_images.npy"), mmap_mode='c')
+        self.labels = torch.from_numpy(np.load(os.path.join(packed_dir, f"{partition}_labels.npy")))
+        with open(os.path.join(packed_dir, f"{partition}_filenames.json")) as f:
+            self.filenames = json.load(f)
+        self.transform = transform
 
-    batch_size = 16
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=2, pin_memory=True)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=2, pin_memory=True)
+    def __len__(self):
+        return len(self.labels)
 
-    # Initialize model and training components
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    num_classes = len(train_dataset.annotations['Majority Vote Label'].unique())
-    model = BaselineModel(num_classes=num_classes).to(device)
-    criterion = nn.CrossEntropyLoss(label_smoothing=0.1)
-    optimizer = optim.Adam(model.parameters(), lr=0.0003)
+    def __getitem__(self, idx):
+        image = torch.from_numpy(self.images[idx]).permute(2, 0, 1)
+        if self.transform:
+            image = self.transform(image)
+        return image, self.labels[idx]
 
-    # Training loop
-    print("Starting training...")
-    num_epochs = 10
-    training_start_time = time.time()
-    training_losses = []
-    training_accuracies = []
+def packed_transform(mean=MHIST_MEAN, std=MHIST_STD):
+    """uint8 (3, H, W) -> normalized float, matching ToTensor() + Normalize() on the PIL path."""
+    return transforms.Compose([
+        transforms.ConvertImageDtype(torch.float32),
+        transforms.Normalize(mean=mean, std=std)
+    ])
 
-    for epoch in range(num_epochs):
-        model.train()
-        epoch_loss = 0
-        correct = 0
-        total = 0
+def benchmark_mhist_loading(annotations_file, img_dir, packed_dir, partition='train', batch_size=16, num_workers=2):
+    """Samples per second of the PIL path vs the packed store, and a bit-exactness check."""
+    pil_dataset = MHISTDataset(annotations_file, img_dir, partition=partition, transform=mhist_transform())
+    if not os.path.exists(os.path.join(packed_dir, f"{partition}_images.npy")):
+        pack_mhist_partition(annotations_file, img_dir, partition, packed_dir)
+    packed_dataset = PackedMHISTDataset(packed_dir, partition, transform=packed_transform())
 
-        for images, labels in train_loader:
-            images, labels = images.to(device), labels.to(device)
+    mismatches = sum(not torch.equal(pil_dataset[idx][0], packed_dataset[idx][0]) for idx in range(len(pil_dataset)))
 
-            optimizer.zero_grad()
-            outputs = model(images)
-            loss = criterion(outputs, labels)
+    results = {}
+    for name, dataset in [('pil', pil_dataset), ('packed', packed_dataset)]:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+        start_time = time.perf_counter()
+        for _ in loader:
+            pass
+        results[name] = len(dataset) / (time.perf_counter() - start_time)
 
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            optimizer.step()
+    print(f"PIL: {results['pil']:.0f} samples/s, packed: {results['packed']:.0f} samples/s "
+          f"({results['packed'] / results['pil']:.1f}x), mismatched tensors: {mismatches}/{len(pil_dataset)}")
+    results['mismatches'] = mismatches
+    return results
 
-            epoch_loss += loss.item()
-            _, predicted = torch.max(outputs.data, 1)
-            total += labels.size(0)
-            correct += (predicted == labels).sum().item()
+if __name__ == "__main__":
+    packed_dir = os.path.join(data_path, "packed")
+    for partition in ['train', 'test']:
+        pack_mhist_partition(annotations_file, img_dir, partition, packed_dir)
+    loading_results = benchmark_mhist_loading(annotations_file, img_dir, packed_dir)
+
+
+"""Training engine"""
+
+def _autocast(device, amp_dtype):
+    return torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
+
+def _to_device(inputs, labels, device, channels_last=False, batch_transform=None):
+    inputs = inputs.to(device, non_blocking=True)
+    if batch_transform is not None:
+        inputs = batch_transform(inputs)
+    if channels_last and inputs.dim() == 4:
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+    return inputs, labels.to(device, non_blocking=True)
+
+class ResumableRandomSampler(Sampler):
+    """Shuffles like RandomSampler, but the order is a function of (seed, epoch)
+    and an epoch can be started part-way through, so a checkpointed run sees
+    exactly the same batches after a resume."""
+
+    def __init__(self, data_source, seed=None):
+        self.num_samples = len(data_source)
+        self.seed = int(torch.randint(2**62, ()).item()) if seed is None else seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def set_start(self, start):
+        """Skip the first start samples of the current epoch (applies to the next iteration only)."""
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_samples, generator=generator).tolist()
+        start, self.start = self.start, 0
+        return iter(order[start:])
 
-        avg_loss = epoch_loss / len(train_loader)
-        accuracy = 100 * correct / total
-        training_losses.append(avg_loss)
-        training_accuracies.append(accuracy)
+    def __len__(self):
+        return self.num_samples - self.start
+
+def make_train_loader(dataset, batch_size=16, seed=None, **loader_kwargs):
+    """Shuffled training loader whose data order can be checkpointed and resumed.
+
+    The loader gets its own generator so creating an iterator (which draws the
+    worker base seed) does not consume the global RNG that dropout uses.
+    """
+    return DataLoader(dataset, batch_size=batch_size, sampler=ResumableRandomSampler(dataset, seed),
+                      generator=torch.Generator(), **loader_kwargs)
+
+def _snapshot(obj):
+    """Detached CPU copy of a (nested) state dict, safe to serialize while training continues."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class AsyncCheckpointer:
+    """Writes training checkpoints on a background thread.
+
+    save() copies the state to CPU on the calling thread (the only part the
+    training step waits for) and hands serialization to a single writer thread.
+    Files are written to a temporary name and moved into place with os.replace,
+    so a crash mid-write leaves the previous checkpoint intact. At most one write
+    is in flight: a new save waits for the previous one to finish.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _write(self, state):
+        tmp_path = f"{self.path}.tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def save(self, state):
+        state = _snapshot(state)
+        self.wait()
+        self._pending = self._executor.submit(self._write, state)
+
+    def wait(self):
+        """Block until the last submitted write is on disk (re-raises write errors)."""
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+def train_one_epoch(forward, model, loader, optimizer, criterion, device, amp_dtype=None, channels_last=False,
+                    start_step=0, totals=None, on_step=None, batch_transform=None):
+    """One pass over loader. Returns (loss sum, correct count, total); the first two stay on device.
+
+    When resuming part-way through an epoch, start_step is the number of batches
+    already done and totals the (loss sum, correct, total) accumulated before
+    the checkpoint. on_step(step, loss sum, correct, total) is called after every
+    optimizer step, with step counted from the start of the epoch.
+    batch_transform runs (in training mode) on each collated batch on the device.
+    """
+    model.train()
+    if batch_transform is not None:
+        batch_transform.train()
+    epoch_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    total = 0
+    if totals is not None:
+        epoch_loss += totals[0]
+        correct += totals[1]
+        total = totals[2]
+
+    for step, (inputs, labels) in enumerate(loader, start=start_step + 1):
+        inputs, labels = _to_device(inputs, labels, device, channels_last, batch_transform)
+
+        optimizer.zero_grad(set_to_none=True)
+        with _autocast(device, amp_dtype):
+            outputs = forward(inputs)
+            loss = criterion(outputs, labels)
 
-        print(f'Epoch {epoch+1}: Loss = {avg_loss:.4f}, Accuracy = {accuracy:.2f}%')
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+        optimizer.step()
 
-    training_time = time.time() - training_start_time
+        epoch_loss += loss.detach()
+        correct += (outputs.detach().argmax(dim=1) == labels).sum()
+        total += labels.size(0)
+        if on_step is not None:
+            on_step(step, epoch_loss, correct, total)
+    return epoch_loss, correct, total
 
-    # Enhanced evaluation
-    print("\nEvaluating model...")
+def predict(forward, model, loader, criterion, device, amp_dtype=None, channels_last=False, batch_transform=None):
+    """Predictions and labels over loader (copied to the host once) and the summed loss."""
     model.eval()
-    test_loss = 0
+    if batch_transform is not None:
+        batch_transform.eval()
+    test_loss = torch.zeros((), device=device)
     all_preds = []
     all_labels = []
 
-    testing_start_time = time.time()
-    with torch.no_grad():
-        for images, labels in test_loader:
-            images, labels = images.to(device), labels.to(device)
-            outputs = model(images)
-            loss = criterion(outputs, labels)
+    with torch.no_grad(), _autocast(device, amp_dtype):
+        for inputs, labels in loader:
+            inputs, labels = _to_device(inputs, labels, device, channels_last, batch_transform)
+            outputs = forward(inputs)
+            test_loss += criterion(outputs, labels).float()
+            all_preds.append(outputs.argmax(dim=1))
+            all_labels.append(labels)
+
+    return torch.cat(all_preds).cpu().numpy(), torch.cat(all_labels).cpu().numpy(), test_loss
+
+def train_model(model, train_loader, test_loader, num_epochs=10, lr=0.0003, device=None, forward=None,
+                amp_dtype=None, channels_last=False, compile_model=False, flops_input=(3, 128, 128),
+                checkpoint_path=None, checkpoint_every=None, resume=False, batch_transform=None):
+    """Train and evaluate any classifier on MHIST loaders.
+
+    forward overrides the callable used on each batch (e.g. model.forward_head on
+    cached features); only parameters with requires_grad are optimized. Speed-ups
+    are opt-in: amp_dtype (e.g. torch.bfloat16) enables autocast, channels_last
+    switches 4-d inputs and weights to NHWC, and compile_model wraps the forward
+    in torch.compile. Loss and accuracy are accumulated on the device and read
+    back once per epoch.
+
+    With checkpoint_path set, model, optimizer, RNG and data-order state are
+    written asynchronously at the end of every epoch and, if checkpoint_every is
+    given, every checkpoint_every steps. resume=True continues from an existing
+    checkpoint at the exact batch it was taken; this needs a train_loader built
+    with make_train_loader.
+
+    batch_transform (e.g. mhist_batch_transform()) is applied to every
+    collated batch on the device, so loaders can yield raw uint8 images; it
+    augments during training and only converts and normalizes for evaluation.
+    """
+    device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    model = model.to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    forward = forward or model
+    if compile_model:
+        forward = torch.compile(forward)
 
-            test_loss += loss.item()
-            _, predicted = torch.max(outputs.data, 1)
+    criterion = nn.CrossEntropyLoss(label_smoothing=0.1)
+    optimizer = optim.Adam([p for p in model.parameters() if p.requires_grad], lr=lr)
+    if batch_transform is not None:
+        batch_transform = batch_transform.to(device)
+    loop_kwargs = {'device': device, 'amp_dtype': amp_dtype, 'channels_last': channels_last,
+                   'batch_transform': batch_transform}
 
-            # Store predictions and labels for metrics
-            all_preds.extend(predicted.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
+    # Training loop
+    print("Starting training...")
+    training_start_time = time.time()
+    training_losses = []
+    training_accuracies = []
+    training_throughput = []
+
+    sampler = train_loader.sampler
+    checkpointer = None
+    start_epoch, start_step, totals = 0, 0, None
+    if checkpoint_path is not None:
+        if not isinstance(sampler, ResumableRandomSampler):
+            raise ValueError("checkpointing needs a train_loader built with make_train_loader")
+        checkpointer = AsyncCheckpointer(checkpoint_path)
+        if resume and os.path.exists(checkpoint_path):
+            checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
+            model.load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            sampler.seed = checkpoint['sampler_seed']
+            start_epoch, start_step, totals = checkpoint['epoch'], checkpoint['step'], checkpoint['totals']
+            training_losses = checkpoint['history']['losses']
+            training_accuracies = checkpoint['history']['accuracies']
+            training_throughput = checkpoint['history']['samples_per_sec']
+            set_rng_state(checkpoint['rng'])
+            print(f"Resumed from {checkpoint_path} at epoch {start_epoch + 1}, step {start_step}")
+
+    def save_checkpoint(epoch, step, totals):
+        checkpointer.save({
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'epoch': epoch,
+            'step': step,
+            'totals': totals,
+            'sampler_seed': sampler.seed,
+            'history': {'losses': training_losses, 'accuracies': training_accuracies,
+                        'samples_per_sec': training_throughput},
+            'rng': rng_state(),
+        })
+
+    for epoch in range(start_epoch, num_epochs):
+        epoch_start_time = time.time()
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+        step = start_step if epoch == start_epoch else 0
+        if step:
+            sampler.set_start(step * train_loader.batch_size)
+
+        if checkpointer is not None and checkpoint_every:
+            def on_step(step, epoch_loss, correct, total, epoch=epoch):
+                # The last step of an epoch is covered by the end-of-epoch checkpoint
+                if step % checkpoint_every == 0 and step < len(train_loader):
+                    save_checkpoint(epoch, step, (epoch_loss.item(), correct.item(), total))
+        else:
+            on_step = None
+
+        epoch_loss, correct, total = train_one_epoch(forward, model, train_loader, optimizer, criterion,
+                                                     start_step=step, totals=totals if step else None,
+                                                     on_step=on_step, **loop_kwargs)
+
+        # Single host sync per epoch
+        avg_loss = epoch_loss.item() / len(train_loader)
+        accuracy = 100 * correct.item() / total
+        samples_per_sec = total / (time.time() - epoch_start_time)
+        training_losses.append(avg_loss)
+        training_accuracies.append(accuracy)
+        training_throughput.append(samples_per_sec)
 
-    testing_time = time.time() - testing_start_time
-    avg_test_loss = test_loss / len(test_loader)
+        print(f'Epoch {epoch+1}: Loss = {avg_loss:.4f}, Accuracy = {accuracy:.2f}%, '
+              f'Throughput = {samples_per_sec:.1f} samples/s')
+        if checkpointer is not None:
+            save_checkpoint(epoch + 1, 0, None)
 
-    # Convert lists to numpy arrays
-    all_preds = np.array(all_preds)
-    all_labels = np.array(all_labels)
+    if checkpointer is not None:
+        checkpointer.close()
+    training_time = time.time() - training_start_time
+
+    # Evaluation
+    print("\nEvaluating model...")
+    testing_start_time = time.time()
+    all_preds, all_labels, test_loss = predict(forward, model, test_loader, criterion, **loop_kwargs)
+    testing_time = time.time() - testing_start_time
+    avg_test_loss = test_loss.item() / len(test_loader)
+    test_throughput = len(all_labels) / testing_time
 
     # Calculate comprehensive metrics
+    from sklearn.metrics import confusion_matrix, classification_report, precision_recall_fscore_support
     accuracy = 100 * (all_preds == all_labels).mean()
     precision, recall, f1, _ = precision_recall_fscore_support(all_labels, all_preds, labels=[0, 1], average=None)
 
@@ -177,20 +617,23 @@ def train_baseline_model(annotations_file, img_dir):
     print("\nTest Results:")
     print(f"Test Loss: {avg_test_loss:.4f}")
     print(f"Overall Accuracy: {accuracy:.2f}%")
+
     # Print full classification report
     print("\nDetailed Classification Report:")
-    print(classification_report(all_labels, all_preds, target_names=['SSA', 'HP'], digits=4))
-
+    print(classification_report(all_labels, all_preds, target_names=MHIST_CLASSES, digits=4))
 
-    # Print timing and complexity metrics
+    # Training/Testing time and model complexity
     print(f"\nTraining Time: {training_time:.2f}s")
     print(f"Testing Time: {testing_time:.2f}s")
+    print(f"Throughput: train {sum(training_throughput) / len(training_throughput):.1f} samples/s, "
+          f"test {test_throughput:.1f} samples/s")
 
-    # Calculate model complexity
-    flops, params = get_model_complexity_info(model.cpu(), (3, 128, 128), as_strings=False, print_per_layer_stat=False)
+    # Calculate FLOPs
+    from ptflops import get_model_complexity_info
+    flops, params = get_model_complexity_info(model.cpu(), flops_input, as_strings=False, print_per_layer_stat=False)
     print(f"Model FLOPs: {flops:e}")
 
-    # Return comprehensive metrics dictionary
+    # Return all metrics for comparison
     return {
         'test_loss': avg_test_loss,
         'accuracy': accuracy,
@@ -203,10 +646,51 @@ def train_baseline_model(annotations_file, img_dir):
         'confusion_matrix': confusion_matrix(all_labels, all_preds),
         'training_history': {
             'losses': training_losses,
-            'accuracies': training_accuracies
-        }
+            'accuracies': training_accuracies,
+            'samples_per_sec': training_throughput
+        },
+        'test_samples_per_sec': test_throughput,
+        'model': model
     }
 
+
+"""Baseline Model"""
+
+class BaselineModel(nn.Module):
+    """Simple ResNet18-based classification model."""
+    def __init__(self, num_classes, pretrained=True):
+        super().__init__()
+
+        # Load pretrained ResNet18
+        self.resnet = pretrained_resnet18(pretrained)
+
+        # Replace the final layer
+        num_features = self.resnet.fc.in_features
+        self.resnet.fc = nn.Sequential(
+            nn.Linear(num_features, 256),
+            nn.LayerNorm(256),
+            nn.GELU(),
+            nn.Dropout(0.1),
+            nn.Linear(256, num_classes)
+        )
+
+    def forward(self, x):
+        return self.resnet(x)
+
+def train_baseline_model(annotations_file, img_dir, packed_dir=None, batch_size=16, **train_kwargs):
+    """Train and evaluate the baseline model; train_kwargs are passed to train_model.
+
+    With a batch_transform in train_kwargs the datasets yield uint8 images and
+    conversion, augmentation and normalization happen per batch.
+    """
+    raw = train_kwargs.get('batch_transform') is not None
+    train_dataset, test_dataset = mhist_datasets(annotations_file, img_dir, packed_dir, raw=raw)
+    train_loader = make_train_loader(train_dataset, batch_size, num_workers=2, pin_memory=True)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=2, pin_memory=True)
+
+    model = BaselineModel(num_classes=len(MHIST_CLASSES))
+    return train_model(model, train_loader, test_loader, **train_kwargs)
+
 if __name__ == "__main__":
     annotations_file = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/annotations.csv"
     img_dir = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/images"
@@ -214,39 +698,151 @@ if __name__ == "__main__":
 
 """Hybrid model: ResNet18 + Mamba"""
 
-class MHISTDataset(Dataset):
-    """Dataset class for MHIST data."""
-    def __init__(self, annotations_file, img_dir, partition, transform=None):
-        self.annotations = pd.read_csv(annotations_file)
-        self.annotations = self.annotations[self.annotations['Partition'] == partition]
-        self.img_dir = img_dir
-        self.transform = transform
-        self.label_map = {'SSA': 0, 'HP': 1}
-
-    def __len__(self):
-        return len(self.annotations)
-
-    def __getitem__(self, idx):
-        img_path = os.path.join(self.img_dir, self.annotations.iloc[idx, 0])
-        image = Image.open(img_path).convert("RGB")
-        label = self.label_map[self.annotations.iloc[idx, 1]]
-        if self.transform:
-            image = self.transform(image)
-        return image, label
+SCAN_IMPLS = ("loop", "parallel", "chunked")
+
+def selective_scan(x, dt, A, B, C, hidden=None, block_size=32):
+    """Selective scan over a whole (sub)sequence.
+
+    x, dt: (batch, d_inner, seq_len); A: (d_inner, d_state); B, C: (batch, seq_len, d_state);
+    hidden: optional (batch, d_inner, d_state) state carried in from earlier steps.
+    Returns the output without the D skip term and the final hidden state.
+
+    The sequence is cut into blocks of block_size steps. A does not depend on
+    time, so inside a block the decay since the block start is
+    exp(cumsum(dt) * A) and every state is a prefix sum (a small triangular
+    matmul) of the inputs divided by that decay; only the state at the end of a
+    block is carried to the next one. The block is halved until
+    block_size * max(dt) * max(|A|) is below 60, so the division cannot overflow;
+    if that takes it down to a single step, the recurrence is stepped directly.
+    States are laid out as (batch, d_state, d_inner, time) with time innermost,
+    and without autograd every block reuses the same buffers so the working set
+    stays in cache.
+    """
+    batch_size, d_inner, seq_len = x.shape
+    d_state = A.shape[-1]
+
+    # Largest log-decay inside a block is at most block_size * max(dt) * max(|A|)
+    max_log_decay = (dt.detach().amax() * A.detach().abs().amax()).item()
+    while block_size > 1 and block_size * max_log_decay >= 60:
+        block_size //= 2
+    upper = torch.ones(block_size, block_size, device=x.device, dtype=x.dtype).triu()
+
+    A_n = A.t().contiguous().unsqueeze(-1)             # (d_state, d_inner, 1)
+    B_n = B.transpose(1, 2).contiguous().unsqueeze(2)  # (batch, d_state, 1, seq_len)
+    C_n = C.transpose(1, 2).contiguous().unsqueeze(2)
+    h = x.new_zeros(batch_size, d_state, d_inner) if hidden is None else hidden.transpose(1, 2)
+
+    if block_size == 1:
+        # exp(dt * A) can underflow to 0 here, so step the recurrence instead of dividing by it
+        ys = []
+        for t in range(seq_len):
+            h = h * torch.exp(dt[:, None, :, t] * A_n[..., 0]) + x[:, None, :, t] * B_n[..., 0, t, None]
+            ys.append((h * C_n[..., 0, t, None]).sum(1))
+        return torch.stack(ys, dim=-1), h.transpose(1, 2)
+
+    if torch.is_grad_enabled() and any(t is not None and t.requires_grad for t in (x, dt, A, B, C, hidden)):
+        ys = []
+        for start in range(0, seq_len, block_size):
+            block = slice(start, min(start + block_size, seq_len))
+            steps = block.stop - start
+            decay = torch.exp((dt[..., block] @ upper[:steps, :steps]).unsqueeze(1) * A_n)
+            states = (x[:, None, :, block] * B_n[..., block] / decay @ upper[:steps, :steps]
+                      + h.unsqueeze(-1)) * decay
+            ys.append((states * C_n[..., block]).sum(1))
+            h = states[..., -1]
+        return torch.cat(ys, dim=-1), h.transpose(1, 2)
+
+    y = x.new_empty(batch_size, d_inner, seq_len)
+    for start in range(0, seq_len, block_size):
+        stop = min(start + block_size, seq_len)
+        steps = stop - start
+        if start == 0 or steps < block_size:
+            decay_buf, inputs_buf, states_buf = (
+                x.new_empty(batch_size, d_state, d_inner, steps) for _ in range(3))
+        dt_cum = dt[..., start:stop] @ upper[:steps, :steps]
+        decay = torch.mul(dt_cum.unsqueeze(1), A_n, out=decay_buf).exp_()
+        inputs = torch.mul(x[:, None, :, start:stop], B_n[..., start:stop], out=inputs_buf).div_(decay)
+        inputs[..., 0] += h
+        states = torch.mm(inputs.view(-1, steps), upper[:steps, :steps], out=states_buf.view(-1, steps))
+        states = states.view_as(decay).mul_(decay)
+        h = states[..., -1].clone()
+        torch.sum(states.mul_(C_n[..., start:stop]), dim=1, out=y[..., start:stop])
+    return y, h.transpose(1, 2)
+
+class ChunkedSelectiveScan(torch.autograd.Function):
+    """Memory-bounded selective scan.
+
+    The sequence is processed chunk_size steps at a time with the hidden state
+    carried across chunk boundaries. Only the boundary states are kept for
+    backward; the states inside each chunk are recomputed there, so the
+    (batch, d_inner, d_state, seq_len) state tensor is never held at once.
+    """
+
+    @staticmethod
+    def forward(ctx, x, dt, A, B, C, chunk_size):
+        batch_size, d_inner, seq_len = x.shape
+        hidden = x.new_zeros(batch_size, d_inner, A.shape[-1])
+
+        ys, boundaries = [], []
+        for start in range(0, seq_len, chunk_size):
+            end = min(start + chunk_size, seq_len)
+            boundaries.append(hidden)
+            y, hidden = selective_scan(x[..., start:end], dt[..., start:end], A,
+                                       B[:, start:end], C[:, start:end], hidden)
+            ys.append(y)
+
+        ctx.save_for_backward(x, dt, A, B, C, torch.stack(boundaries))
+        ctx.chunk_size = chunk_size
+        return torch.cat(ys, dim=-1)
+
+    @staticmethod
+    def backward(ctx, grad_y):
+        x, dt, A, B, C, boundaries = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        seq_len = x.shape[-1]
+
+        grad_x, grad_dt = torch.zeros_like(x), torch.zeros_like(dt)
+        grad_B, grad_C = torch.zeros_like(B), torch.zeros_like(C)
+        grad_A = torch.zeros_like(A)
+        grad_hidden = torch.zeros_like(boundaries[0])
+
+        # Walk the chunks backwards, carrying the gradient of the boundary state
+        for idx in reversed(range(len(boundaries))):
+            start = idx * chunk_size
+            end = min(start + chunk_size, seq_len)
+            with torch.enable_grad():
+                inputs = [t.detach().requires_grad_() for t in (
+                    x[..., start:end], dt[..., start:end], A, B[:, start:end], C[:, start:end], boundaries[idx])]
+                y, hidden = selective_scan(*inputs)
+                grads = torch.autograd.grad((y, hidden), inputs, (grad_y[..., start:end], grad_hidden))
+
+            grad_x[..., start:end] = grads[0]
+            grad_dt[..., start:end] = grads[1]
+            grad_A += grads[2]
+            grad_B[:, start:end] = grads[3]
+            grad_C[:, start:end] = grads[4]
+            grad_hidden = grads[5]
+
+        return grad_x, grad_dt, grad_A, grad_B, grad_C, None
 
 class Mamba(nn.Module):
     """Mamba layer implementation for sequential modeling."""
     def __init__(self, d_model, d_state=16, d_conv=4, expand=2.0, dt_rank=16,
                  dt_min=0.001, dt_max=0.1, dt_init="random", dt_scale=1.0,
-                 dt_init_floor=1e-4, conv_bias=True, bias=False, device=None, dtype=None):
+                 dt_init_floor=1e-4, conv_bias=True, bias=False, scan_impl="loop",
+                 chunk_size=64, device=None, dtype=None):
         factory_kwargs = {"device": device, "dtype": dtype}
         super().__init__()
+        if scan_impl not in SCAN_IMPLS:
+            raise ValueError(f"scan_impl must be one of {SCAN_IMPLS}, got {scan_impl!r}")
         self.d_model = d_model
         self.d_state = d_state
         self.d_conv = d_conv
         self.expand = expand
         self.d_inner = int(self.expand * self.d_model)
         self.dt_rank = dt_rank
+        self.scan_impl = scan_impl
+        self.chunk_size = chunk_size
 
         # Initialize layers
         self.in_proj = nn.Linear(self.d_model, self.d_inner * 2, bias=bias, **factory_kwargs)
@@ -283,7 +879,8 @@ class Mamba(nn.Module):
         self.D = nn.Parameter(torch.ones(self.d_inner, device=device))
         self.out_proj = nn.Linear(self.d_inner, self.d_model, bias=bias, **factory_kwargs)
 
-    def forward(self, x):
+    def _ssm_inputs(self, x):
+        """Project (batch, seq_len, d_model) inputs to the scan inputs (x, z, dt, A, B, C)."""
         batch_size, seq_len, _ = x.shape
 
         # Input projection and reshaping
@@ -301,13 +898,77 @@ class Mamba(nn.Module):
 
         # Compute SSM parameters
         A = -torch.exp(self.A_log.float())
-        dt = F.softplus(dt + self.dt_proj.bias[None, :, None].float())
+        dt = F.softplus(dt + self._dt_bias()[None, :, None].float())
+        return x, z, dt, A, B, C
+
+    def forward(self, x):
+        x, z, dt, A, B, C = self._ssm_inputs(x)
+
+        # Selective scan
+        if self.scan_impl == "parallel":
+            y = self._scan_parallel(x, dt, A, B, C)
+        elif self.scan_impl == "chunked":
+            y = self._scan_chunked(x, dt, A, B, C)
+        else:
+            y = self._scan_loop(x, dt, A, B, C)
+
+        # Final processing
+        y = y * self.act(z)
+        y = y.transpose(1, 2)
+        return self.out_proj(y)
+
+    def _dt_bias(self):
+        # Dynamically quantized Linear layers expose bias() as a method
+        bias = self.dt_proj.bias
+        return bias() if callable(bias) else bias
+
+    def allocate_inference_state(self, batch_size, device=None, dtype=None):
+        """Zero state for step(): the last d_conv - 1 conv inputs and the SSM hidden state."""
+        device = device if device is not None else self.A_log.device
+        dtype = dtype if dtype is not None else self.conv1d.weight.dtype
+        conv_state = torch.zeros(batch_size, self.d_inner, self.d_conv - 1, device=device, dtype=dtype)
+        ssm_state = torch.zeros(batch_size, self.d_inner, self.d_state, device=device, dtype=dtype)
+        return conv_state, ssm_state
+
+    def step(self, x, state):
+        """Process one token per sequence, x: (batch, d_model) -> (batch, d_model).
+
+        state comes from allocate_inference_state() and is updated in place, so each
+        call costs O(1) in the number of tokens already seen.
+        """
+        conv_state, ssm_state = state
+
+        # Input projection
+        x, z = self.in_proj(x).chunk(2, dim=-1)
+
+        # Causal depthwise convolution over the cached inputs plus the new one
+        window = torch.cat([conv_state, x.unsqueeze(-1)], dim=-1)
+        conv_state.copy_(window[..., 1:])
+        x = torch.sum(window * self.conv1d.weight.squeeze(1), dim=-1)
+        if self.conv1d.bias is not None:
+            x = x + self.conv1d.bias
+        x = self.act(x)
+
+        # Project and split parameters
+        dt, B, C = torch.split(self.x_proj(x), [self.dt_rank, self.d_state, self.d_state], dim=-1)
+        A = -torch.exp(self.A_log.float())
+        dt = F.softplus(self.dt_proj(dt) + self._dt_bias().float())
+
+        # Single selective scan step
+        ssm_state.copy_(ssm_state * torch.exp(dt.unsqueeze(-1) * A) + x.unsqueeze(-1) * B.unsqueeze(1))
+        y = torch.bmm(ssm_state, C.unsqueeze(-1)).squeeze(-1) + self.D * x
+
+        y = y * self.act(z)
+        return self.out_proj(y)
+
+    def _scan_loop(self, x, dt, A, B, C):
+        """Reference selective scan, one time step per Python iteration."""
+        batch_size, _, seq_len = x.shape
 
         # Initialize state and output
         y = torch.zeros_like(x)
         hidden = torch.zeros((batch_size, self.d_inner, self.d_state), device=x.device, dtype=x.dtype)
 
-        # Selective scan
         for t in range(seq_len):
             hidden = hidden * torch.exp(dt[:, :, t:t+1] * A.unsqueeze(0))
             hidden = hidden + x[:, :, t:t+1] * B[:, t:t+1].view(batch_size, 1, self.d_state)
@@ -316,29 +977,36 @@ class Mamba(nn.Module):
             C_t = C[:, t].view(batch_size, self.d_state)
             out_t = torch.bmm(hidden_reshaped, C_t.unsqueeze(-1)).squeeze(-1)
             y[:, :, t] = out_t + self.D * x[:, :, t]
+        return y
 
-        # Final processing
-        y = y * self.act(z)
-        y = y.transpose(1, 2)
-        return self.out_proj(y)
+    def _scan_parallel(self, x, dt, A, B, C):
+        """Vectorized selective scan over blocks of time steps (see selective_scan)."""
+        y, _ = selective_scan(x, dt, A, B, C)
+        return y + self.D[None, :, None] * x
+
+    def _scan_chunked(self, x, dt, A, B, C):
+        """Selective scan in chunks of chunk_size steps, recomputing chunk states in backward."""
+        y = ChunkedSelectiveScan.apply(x, dt, A, B, C, self.chunk_size)
+        return y + self.D[None, :, None] * x
 
 class HybridModel(nn.Module):
     """Hybrid model combining ResNet backbone with Mamba sequential processing."""
-    def __init__(self, num_classes):
+    def __init__(self, num_classes, pretrained=True, d_state=8, d_conv=4, expand=1.0, dt_rank=8):
         super().__init__()
+        self.config = {'d_state': d_state, 'd_conv': d_conv, 'expand': expand, 'dt_rank': dt_rank}
 
         # CNN Backbone
-        resnet = resnet18(weights=ResNet18_Weights.DEFAULT)
+        resnet = pretrained_resnet18(pretrained)
         self.backbone = nn.Sequential(*list(resnet.children())[:-1])
 
         # Feature processing
         self.norm = nn.LayerNorm(512)
         self.mamba = Mamba(
             d_model=512,
-            d_state=8,
-            d_conv=4,
-            expand=1.0,
-            dt_rank=8
+            d_state=d_state,
+            d_conv=d_conv,
+            expand=expand,
+            dt_rank=dt_rank
         )
 
         # Classification head
@@ -351,141 +1019,1842 @@ class HybridModel(nn.Module):
         )
 
     def forward(self, x):
+        return self.forward_head(self.forward_features(x))
+
+    def forward_features(self, x):
+        """Pooled 512-d backbone features."""
         features = self.backbone(x)
-        features = features.squeeze(-1).squeeze(-1)
+        return features.squeeze(-1).squeeze(-1)
+
+    def forward_head(self, features):
+        """LayerNorm -> Mamba -> classifier on pooled backbone features."""
         features = self.norm(features)
         features = features.unsqueeze(1)
         mamba_out = self.mamba(features)
         pooled = mamba_out.mean(dim=1)
         return self.classifier(pooled)
 
+SCAN_ORDERS = ("row", "column", "snake")
+
+class TokenHybridModel(nn.Module):
+    """ResNet18 feature map flattened into a token sequence and processed by Mamba.
+
+    Unlike HybridModel, which pools to a single vector (a length-1 sequence),
+    every spatial position of the layer3 (256-d) or layer4 (512-d) map is a
+    token. token_grid adaptively pools the map to (token_grid x token_grid)
+    first to trade resolution for latency. scan_order is the path through the
+    grid: row-major, column-major or snake (row-major, every other row
+    reversed, so consecutive tokens stay spatially adjacent). bidirectional adds
+    a second Mamba over the reversed sequence and sums the two outputs.
+    """
+    def __init__(self, num_classes, pretrained=True, feature_layer='layer4', token_grid=None, scan_order='row',
+                 bidirectional=False, d_state=8, d_conv=4, expand=1.0, dt_rank=8, scan_impl='parallel'):
+        super().__init__()
+        if feature_layer not in ('layer3', 'layer4'):
+            raise ValueError(f"feature_layer must be 'layer3' or 'layer4', got {feature_layer!r}")
+        if scan_order not in SCAN_ORDERS:
+            raise ValueError(f"scan_order must be one of {SCAN_ORDERS}, got {scan_order!r}")
+        self.config = {'feature_layer': feature_layer, 'token_grid': token_grid, 'scan_order': scan_order,
+                       'bidirectional': bidirectional, 'd_state': d_state, 'd_conv': d_conv, 'expand': expand,
+                       'dt_rank': dt_rank, 'scan_impl': scan_impl}
+
+        # CNN Backbone up to the chosen stage
+        resnet = pretrained_resnet18(pretrained)
+        stages = ['conv1', 'bn1', 'relu', 'maxpool', 'layer1', 'layer2', 'layer3', 'layer4']
+        self.backbone = nn.Sequential(*[getattr(resnet, name) for name in stages[:stages.index(feature_layer) + 1]])
+        self.pool = nn.AdaptiveAvgPool2d(token_grid) if token_grid else nn.Identity()
+        d_model = 256 if feature_layer == 'layer3' else 512
+        self.scan_order = scan_order
+        self._scan_index = {}
+
+        # Token processing
+        self.norm = nn.LayerNorm(d_model)
+        mamba_kwargs = dict(d_model=d_model, d_state=d_state, d_conv=d_conv, expand=expand, dt_rank=dt_rank,
+                            scan_impl=scan_impl)
+        self.mamba = Mamba(**mamba_kwargs)
+        self.mamba_reverse = Mamba(**mamba_kwargs) if bidirectional else None
 
-def train_hybrid_model(annotations_file, img_dir):
-    """Train and evaluate the hybrid model."""
-    # Basic transforms without augmentation
-    transform = transforms.Compose([
-        transforms.Resize((128, 128)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-
-    # Create datasets and dataloaders
-    train_dataset = MHISTDataset(annotations_file, img_dir, partition='train', transform=transform)
-    test_dataset = MHISTDataset(annotations_file, img_dir, partition='test', transform=transform)
+        # Classification head
+        self.classifier = nn.Sequential(
+            nn.Linear(d_model, 256),
+            nn.LayerNorm(256),
+            nn.GELU(),
+            nn.Dropout(0.1),
+            nn.Linear(256, num_classes)
+        )
 
-    batch_size = 16
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=2, pin_memory=True)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=2, pin_memory=True)
+    def scan_index(self, height, width, device):
+        """Flat spatial positions in scan order, or None for plain row-major."""
+        if self.scan_order == 'row':
+            return None
+        key = (height, width, device)
+        if key not in self._scan_index:
+            grid = torch.arange(height * width, device=device).view(height, width)
+            if self.scan_order == 'column':
+                grid = grid.t()
+            else:
+                grid[1::2] = grid[1::2].flip(-1)
+            self._scan_index[key] = grid.reshape(-1)
+        return self._scan_index[key]
 
-    # Initialize model and training components
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    num_classes = len(train_dataset.annotations['Majority Vote Label'].unique())
-    model = HybridModel(num_classes=num_classes).to(device)
-    criterion = nn.CrossEntropyLoss(label_smoothing=0.1)
-    optimizer = optim.Adam(model.parameters(), lr=0.0003)
+    def forward(self, x):
+        return self.forward_head(self.forward_features(x))
+
+    def forward_features(self, x):
+        """(B, L, C) token sequence from the backbone feature map, in scan order."""
+        features = self.pool(self.backbone(x))
+        batch_size, channels, height, width = features.shape
+        tokens = features.flatten(2)
+        index = self.scan_index(height, width, tokens.device)
+        if index is not None:
+            tokens = tokens.index_select(2, index)
+        # (B, C, L) -> (B, L, C) as a view; the LayerNorm in forward_head writes the one contiguous copy
+        return tokens.transpose(1, 2)
+
+    def forward_head(self, tokens):
+        """LayerNorm -> Mamba (forward, plus reversed if bidirectional) -> mean over tokens -> classifier."""
+        tokens = self.norm(tokens)
+        mamba_out = self.mamba(tokens)
+        if self.mamba_reverse is not None:
+            mamba_out = mamba_out + self.mamba_reverse(tokens.flip(1)).flip(1)
+        return self.classifier(mamba_out.mean(dim=1))
+
+
+"""Frozen-backbone feature cache"""
+
+def feature_cache_key(backbone, transform, filenames=(), labels=()):
+    """Hash of the backbone weights, transform config and the ordered image filenames and
+    labels of the partition, used to invalidate stale caches."""
+    digest = hashlib.sha256(repr(transform).encode())
+    digest.update(json.dumps([list(filenames), [int(label) for label in labels]]).encode())
+    for name, tensor in backbone.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+def build_feature_cache(model, dataset, cache_dir, partition, batch_size=64, device='cpu'):
+    """Run the backbone once over a partition and store the pooled features in a memory-mapped .npy.
+
+    The cache file name carries feature_cache_key(), so a change to the backbone
+    weights, the transform or the partition's images and labels (e.g. an edited
+    annotations.csv) produces a new cache instead of reusing the old one.
+    Returns the path of the features file.
+    """
+    key = feature_cache_key(model.backbone, dataset.transform, dataset.filenames, dataset.labels)
+    features_path = os.path.join(cache_dir, f"{partition}_{key}_features.npy")
+    meta_path = os.path.join(cache_dir, f"{partition}_{key}_meta.json")
+    if os.path.exists(features_path) and os.path.exists(meta_path):
+        return features_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=2)
+    tmp_path = features_path + ".tmp.npy"
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(dataset), 512))
+    labels = []
+
+    was_training = model.training
+    model.eval()
+    offset = 0
+    with torch.no_grad():
+        for images, batch_labels in loader:
+            batch_features = model.forward_features(images.to(device)).cpu().numpy()
+            features[offset:offset + len(batch_features)] = batch_features
+            offset += len(batch_features)
+            labels.extend(batch_labels.tolist())
+    model.train(was_training)
+    features.flush()
+    del features
+
+    meta = {
+        'filenames': dataset.filenames,
+        'labels': labels,
+        'transform': repr(dataset.transform),
+    }
+    with open(meta_path + ".tmp", 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, features_path)
+    os.replace(meta_path + ".tmp", meta_path)
+    return features_path
+
+class CachedFeatureDataset(Dataset):
+    """Pooled backbone features served from a build_feature_cache() file."""
+    def __init__(self, features_path):
+        self.features = np.load(features_path, mmap_mode='r')
+        with open(features_path.replace("_features.npy", "_meta.json")) as f:
+            meta = json.load(f)
+        self.filenames = meta['filenames']
+        self.labels = torch.tensor(meta['labels'], dtype=torch.long)
+        self.index = {filename: idx for idx, filename in enumerate(self.filenames)}
 
-    # Training loop
-    print("Starting training...")
-    num_epochs = 10
-    training_start_time = time.time()
-    training_losses = []
-    training_accuracies = []
+    def __len__(self):
+        return len(self.labels)
 
-    for epoch in range(num_epochs):
-        model.train()
-        epoch_loss = 0
-        correct = 0
-        total = 0
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.features[idx])), self.labels[idx]
+
+    def get_by_filename(self, filename):
+        return self[self.index[filename]]
+
+
+def train_hybrid_model(annotations_file, img_dir, feature_cache_dir=None, packed_dir=None, batch_size=16,
+                       **train_kwargs):
+    """Train and evaluate the hybrid model; train_kwargs are passed to train_model.
+
+    With feature_cache_dir set, the backbone is frozen: its pooled features are
+    computed once per partition and only the LayerNorm -> Mamba -> classifier
+    head is trained from the cache. A batch_transform in train_kwargs makes the
+    datasets yield uint8 images, as in train_baseline_model.
+    """
+    raw = train_kwargs.get('batch_transform') is not None
+    if raw and feature_cache_dir is not None:
+        raise ValueError("batch_transform cannot be combined with feature_cache_dir: cached features are fixed")
+    train_dataset, test_dataset = mhist_datasets(annotations_file, img_dir, packed_dir, raw=raw)
+    model = HybridModel(num_classes=len(MHIST_CLASSES))
+
+    if feature_cache_dir is not None:
+        # Frozen backbone: train the head on cached features
+        device = torch.device(train_kwargs.get('device') or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        model = model.to(device)
+        for param in model.backbone.parameters():
+            param.requires_grad = False
+        train_dataset = CachedFeatureDataset(build_feature_cache(model, train_dataset, feature_cache_dir, 'train', device=device))
+        test_dataset = CachedFeatureDataset(build_feature_cache(model, test_dataset, feature_cache_dir, 'test', device=device))
+        train_loader = make_train_loader(train_dataset, batch_size)
+        test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+        train_kwargs['forward'] = model.forward_head
+    else:
+        train_loader = make_train_loader(train_dataset, batch_size, num_workers=2, pin_memory=True)
+        test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=2, pin_memory=True)
+
+    return train_model(model, train_loader, test_loader, **train_kwargs)
 
-        for images, labels in train_loader:
-            images, labels = images.to(device), labels.to(device)
+if __name__ == "__main__":
+    annotations_file = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/annotations.csv"
+    img_dir = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/images"
+    metrics = train_hybrid_model(annotations_file, img_dir)
+
+"""Selective scan: loop vs parallel vs chunked"""
+
+def benchmark_scan_impls(seq_lens=(256, 1024, 4096), batch_size=2, d_model=512, d_state=8,
+                         expand=1.0, repeats=3):
+    """Check that the scan implementations agree and time each one.
+
+    Timings are reported for the scan alone (on the same x, dt, A, B, C) and for
+    a full forward pass, whose projections and convolution cost the same for
+    every implementation.
+    """
+    model = Mamba(d_model=d_model, d_state=d_state, expand=expand).eval()
+    print(f"Threads: {torch.get_num_threads()}")
+
+    def timed(fn):
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        return (time.perf_counter() - start_time) / repeats
+
+    results = []
+    for seq_len in seq_lens:
+        x = torch.randn(batch_size, seq_len, d_model)
+        outputs, scan_timings, timings = {}, {}, {}
+        with torch.no_grad():
+            scan_inputs = model._ssm_inputs(x)
+            scan_inputs = scan_inputs[:1] + scan_inputs[2:]
+            for scan_impl in SCAN_IMPLS:
+                scan = getattr(model, f"_scan_{scan_impl}")
+                outputs[scan_impl] = scan(*scan_inputs)
+                scan_timings[scan_impl] = timed(lambda: scan(*scan_inputs))
+                model.scan_impl = scan_impl
+                timings[scan_impl] = timed(lambda: model(x))
+
+        max_err = max((outputs[impl] - outputs["loop"]).abs().max().item() for impl in SCAN_IMPLS)
+        scan_speedups = {impl: scan_timings["loop"] / scan_timings[impl] for impl in SCAN_IMPLS}
+        speedups = {impl: timings["loop"] / timings[impl] for impl in SCAN_IMPLS}
+        print(f"seq_len={seq_len}: max abs err {max_err:.2e}")
+        for label, times, ratios in (("scan", scan_timings, scan_speedups), ("forward", timings, speedups)):
+            summary = ", ".join(f"{impl} {times[impl]*1000:.1f}ms ({ratios[impl]:.2f}x)" for impl in SCAN_IMPLS)
+            print(f"  {label}: {summary}")
+        results.append({'seq_len': seq_len, 'scan_timings': scan_timings, 'scan_speedups': scan_speedups,
+                        'timings': timings, 'speedups': speedups, 'max_abs_err': max_err})
+
+    model.scan_impl = "loop"
+    return results
+
+def check_scan_gradients(seq_len=300, chunk_sizes=(16, 64, 256), batch_size=2, d_model=64, d_state=16,
+                         expand=2.0, atol=1e-4):
+    """Compare gradients of every scan implementation against the loop and report saved activation memory."""
+    torch.manual_seed(0)
+    model = Mamba(d_model=d_model, d_state=d_state, expand=expand)
+    x = torch.randn(batch_size, seq_len, d_model)
+
+    def run(scan_impl, chunk_size=None):
+        model.scan_impl = scan_impl
+        if chunk_size is not None:
+            model.chunk_size = chunk_size
+        model.zero_grad(set_to_none=True)
+        x_in = x.clone().requires_grad_()
+
+        # Bytes of tensors autograd keeps alive between forward and backward
+        saved_bytes = [0]
+        def pack(t):
+            saved_bytes[0] += t.numel() * t.element_size()
+            return t
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            out = model(x_in)
+        out.pow(2).sum().backward()
+
+        grads = {name: p.grad.clone() for name, p in model.named_parameters()}
+        grads['input'] = x_in.grad.clone()
+        return out.detach(), grads, saved_bytes[0]
+
+    ref_out, ref_grads, ref_bytes = run("loop")
+    print(f"loop: saved activations {ref_bytes / 2**20:.1f} MiB")
+
+    configs = [("parallel", None)] + [("chunked", chunk_size) for chunk_size in chunk_sizes]
+    all_close = True
+    for scan_impl, chunk_size in configs:
+        out, grads, saved = run(scan_impl, chunk_size)
+        out_err = (out - ref_out).abs().max().item()
+        grad_err = max(((grads[name] - ref_grads[name]).abs().max() / ref_grads[name].abs().max().clamp(min=1e-12)).item()
+                       for name in ref_grads)
+        all_close &= out_err < atol and grad_err < atol
+        label = scan_impl if chunk_size is None else f"{scan_impl}[{chunk_size}]"
+        print(f"{label}: saved activations {saved / 2**20:.1f} MiB, "
+              f"max output err {out_err:.2e}, max relative grad err {grad_err:.2e}")
+
+    model.scan_impl = "loop"
+    assert all_close, "scan implementations disagree with the reference loop"
+    return all_close
 
-            optimizer.zero_grad()
-            outputs = model(images)
-            loss = criterion(outputs, labels)
+if __name__ == "__main__":
+    scan_results = benchmark_scan_impls()
+    check_scan_gradients()
 
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            optimizer.step()
 
-            epoch_loss += loss.item()
-            _, predicted = torch.max(outputs.data, 1)
-            total += labels.size(0)
-            correct += (predicted == labels).sum().item()
+"""Streaming inference with Mamba.step"""
 
-        avg_loss = epoch_loss / len(train_loader)
-        accuracy = 100 * correct / total
-        training_losses.append(avg_loss)
-        training_accuracies.append(accuracy)
+def check_step_matches_forward(seq_len=64, batch_size=2, d_model=64, d_state=16, d_conv=4, expand=2.0, atol=1e-5):
+    """Feed a sequence token by token through step() and compare with forward()."""
+    torch.manual_seed(0)
+    model = Mamba(d_model=d_model, d_state=d_state, d_conv=d_conv, expand=expand).eval()
+    x = torch.randn(batch_size, seq_len, d_model)
 
-        print(f'Epoch {epoch+1}: Loss = {avg_loss:.4f}, Accuracy = {accuracy:.2f}%')
+    with torch.no_grad():
+        expected = model(x)
+        state = model.allocate_inference_state(batch_size)
+        stepped = torch.stack([model.step(x[:, t], state) for t in range(seq_len)], dim=1)
 
-    training_time = time.time() - training_start_time
+    max_err = (stepped - expected).abs().max().item()
+    print(f"step vs forward: max abs err {max_err:.2e}")
+    assert max_err < atol, "step() does not reproduce forward()"
+    return max_err
 
-    # Evaluation
-    print("\nEvaluating model...")
-    model.eval()
-    test_loss = 0
-    all_preds = []
-    all_labels = []
+def benchmark_step_throughput(num_tokens=512, batch_size=1, d_model=512, d_state=8, expand=1.0):
+    """Tokens per second when streaming with step() vs re-running forward() on the growing prefix."""
+    model = Mamba(d_model=d_model, d_state=d_state, expand=expand).eval()
+    x = torch.randn(batch_size, num_tokens, d_model)
 
-    testing_start_time = time.time()
     with torch.no_grad():
-        for images, labels in test_loader:
-            images, labels = images.to(device), labels.to(device)
-            outputs = model(images)
-            loss = criterion(outputs, labels)
+        state = model.allocate_inference_state(batch_size)
+        start_time = time.perf_counter()
+        for t in range(num_tokens):
+            model.step(x[:, t], state)
+        step_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for t in range(num_tokens):
+            model(x[:, :t + 1])
+        prefix_time = time.perf_counter() - start_time
+
+    step_tps = num_tokens * batch_size / step_time
+    prefix_tps = num_tokens * batch_size / prefix_time
+    print(f"step(): {step_tps:.0f} tokens/s, forward() on prefix: {prefix_tps:.0f} tokens/s "
+          f"({num_tokens} tokens, batch {batch_size})")
+    return {'step_tokens_per_sec': step_tps, 'prefix_tokens_per_sec': prefix_tps}
 
-            test_loss += loss.item()
-            _, predicted = torch.max(outputs.data, 1)
-            all_preds.extend(predicted.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
+if __name__ == "__main__":
+    check_step_matches_forward()
+    step_results = benchmark_step_throughput()
+
+
+"""CPU scaling benchmarks"""
+
+BENCHMARK_CONFIG_KEYS = ['model', 'batch_size', 'seq_len', 'd_state', 'expand', 'threads', 'scan_impl']
+
+DEFAULT_BENCHMARK_GRID = {
+    'Mamba': {'batch_size': [1, 16], 'seq_len': [64, 256, 1024], 'd_state': [8, 16], 'expand': [1.0, 2.0],
+              'threads': [1, 4], 'scan_impl': ['loop', 'parallel', 'chunked']},
+    'BaselineModel': {'batch_size': [1, 16], 'threads': [1, 4]},
+    'HybridModel': {'batch_size': [1, 16], 'threads': [1, 4]},
+}
+
+def _rss_bytes():
+    """Current resident set size of this process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class PeakRSSMonitor:
+    """Samples RSS on a background thread and records the peak seen inside the with-block."""
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start = self.peak = _rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+def time_forward_backward(model, inputs, repeats=10, warmup=2):
+    """Per-iteration forward and backward wall times in milliseconds."""
+    model.train()
+    forward_ms, backward_ms = [], []
+    for i in range(warmup + repeats):
+        model.zero_grad(set_to_none=True)
+        start_time = time.perf_counter()
+        outputs = model(inputs)
+        forward_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        outputs.float().sum().backward()
+        backward_time = time.perf_counter() - start_time
+
+        if i >= warmup:
+            forward_ms.append(forward_time * 1000)
+            backward_ms.append(backward_time * 1000)
+    return forward_ms, backward_ms
+
+def _benchmark_configs(grid):
+    for model_name, axes in grid.items():
+        names = list(axes)
+        for values in itertools.product(*(axes[name] for name in names)):
+            config = dict.fromkeys(BENCHMARK_CONFIG_KEYS)
+            config.update(model=model_name, **dict(zip(names, values)))
+            yield config
+
+def _build_benchmark_model(config):
+    if config['model'] == 'Mamba':
+        model = Mamba(d_model=512, d_state=config['d_state'], expand=config['expand'], dt_rank=16,
+                      scan_impl=config['scan_impl'])
+        inputs = torch.randn(config['batch_size'], config['seq_len'], 512)
+    elif config['model'] == 'BaselineModel':
+        model = BaselineModel(num_classes=len(MHIST_CLASSES), pretrained=False)
+        inputs = torch.randn(config['batch_size'], 3, 128, 128)
+    elif config['model'] == 'HybridModel':
+        model = HybridModel(num_classes=len(MHIST_CLASSES), pretrained=False)
+        inputs = torch.randn(config['batch_size'], 3, 128, 128)
+    else:
+        raise ValueError(f"Unknown benchmark model {config['model']!r}")
+    return model, inputs
+
+def run_benchmark_suite(grid=None, repeats=10, warmup=2, output_path=None):
+    """Sweep the grid on CPU and record latency percentiles, peak RSS and samples/s per config."""
+    grid = grid or DEFAULT_BENCHMARK_GRID
+    default_threads = torch.get_num_threads()
+    results = []
+    for config in _benchmark_configs(grid):
+        torch.set_num_threads(config['threads'] or default_threads)
+        model, inputs = _build_benchmark_model(config)
+        with PeakRSSMonitor() as monitor:
+            forward_ms, backward_ms = time_forward_backward(model, inputs, repeats, warmup)
+
+        result = dict(config)
+        for phase, times in [('forward', forward_ms), ('backward', backward_ms)]:
+            for q in (50, 90, 99):
+                result[f'{phase}_p{q}_ms'] = float(np.percentile(times, q))
+        result['samples_per_sec'] = config['batch_size'] * 1000 / (result['forward_p50_ms'] + result['backward_p50_ms'])
+        result['peak_rss_mb'] = monitor.peak / 2**20
+        result['peak_rss_delta_mb'] = (monitor.peak - monitor.start) / 2**20
+        results.append(result)
+
+        label = ", ".join(f"{k}={config[k]}" for k in BENCHMARK_CONFIG_KEYS if config[k] is not None)
+        print(f"{label}: fwd p50 {result['forward_p50_ms']:.1f}ms, bwd p50 {result['backward_p50_ms']:.1f}ms, "
+              f"{result['samples_per_sec']:.1f} samples/s, peak RSS {result['peak_rss_mb']:.0f}MB "
+              f"(+{result['peak_rss_delta_mb']:.0f}MB)")
+        del model, inputs
+    torch.set_num_threads(default_threads)
+
+    if output_path is not None:
+        save_benchmark_results(results, output_path)
+    return results
+
+def save_benchmark_results(results, path):
+    """Write results as JSON, or CSV if the path ends in .csv."""
+    if path.endswith('.csv'):
+        pd.DataFrame(results).to_csv(path, index=False)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'torch_version': torch.__version__, 'results': results}, f, indent=2)
+
+def load_benchmark_results(path):
+    if path.endswith('.csv'):
+        results = pd.read_csv(path).astype(object).replace({np.nan: None}).to_dict('records')
+        for result in results:
+            for k in ['batch_size', 'seq_len', 'd_state', 'threads']:
+                if result[k] is not None:
+                    result[k] = int(result[k])
+        return results
+    with open(path) as f:
+        return json.load(f)['results']
+
+def compare_benchmark_results(baseline_path, current_path, threshold=0.1,
+                              metrics=('forward_p50_ms', 'backward_p50_ms', 'peak_rss_delta_mb')):
+    """Flag configs whose metrics got worse than the baseline by more than threshold (relative)."""
+    def key(result):
+        return tuple(result[k] for k in BENCHMARK_CONFIG_KEYS)
+
+    baseline = {key(r): r for r in load_benchmark_results(baseline_path)}
+    regressions = []
+    for result in load_benchmark_results(current_path):
+        reference = baseline.get(key(result))
+        if reference is None:
+            continue
+        for metric in metrics:
+            change = (result[metric] - reference[metric]) / max(reference[metric], 1e-9)
+            if change > threshold:
+                regressions.append({**{k: result[k] for k in BENCHMARK_CONFIG_KEYS}, 'metric': metric,
+                                    'baseline': reference[metric], 'current': result[metric], 'change': change})
+
+    for r in regressions:
+        label = ", ".join(f"{k}={r[k]}" for k in BENCHMARK_CONFIG_KEYS if r[k] is not None)
+        print(f"REGRESSION {label}: {r['metric']} {r['baseline']:.2f} -> {r['current']:.2f} (+{r['change']:.0%})")
+    print(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+    return regressions
 
-    testing_time = time.time() - testing_start_time
-    avg_test_loss = test_loss / len(test_loader)
-    # Convert lists to numpy arrays
-    all_preds = np.array(all_preds)
-    all_labels = np.array(all_labels)
+if __name__ == "__main__":
+    benchmark_results = run_benchmark_suite(output_path=os.path.join(data_path, "cpu_benchmark.json"))
 
-    # Calculate comprehensive metrics
-    accuracy = 100 * (all_preds == all_labels).mean()
-    precision, recall, f1, _ = precision_recall_fscore_support(all_labels, all_preds, labels=[0, 1], average=None)
 
-    # Print detailed results
-    print("\nTest Results:")
-    print(f"Test Loss: {avg_test_loss:.4f}")
-    print(f"Overall Accuracy: {accuracy:.2f}%")
+"""Per-module profiling"""
 
-     # Print full classification report
-    print("\nDetailed Classification Report:")
-    print(classification_report(all_labels, all_preds,  target_names=['SSA', 'HP'], digits=4))
+def profile_mhist_models(batch_size=16, trace_dir=None, top=15):
+    """Per-module forward/backward time, allocations and FLOPs for BaselineModel and HybridModel."""
+    images = torch.randn(batch_size, 3, 128, 128)
+    labels = torch.randint(0, len(MHIST_CLASSES), (batch_size,))
+    criterion = nn.CrossEntropyLoss()
 
-    # Training/Testing time and model complexity
-    print(f"\nTraining Time: {training_time:.2f}s")
-    print(f"Testing Time: {testing_time:.2f}s")
+    profilers = {}
+    for model in [BaselineModel(num_classes=len(MHIST_CLASSES), pretrained=False),
+                  HybridModel(num_classes=len(MHIST_CLASSES), pretrained=False)]:
+        name = type(model).__name__
+        model(images)  # warm-up outside the profiler
+        with ModuleProfiler(model) as prof:
+            criterion(model(images), labels).backward()
 
-    # Calculate FLOPs
-    flops, params = get_model_complexity_info(model.cpu(), (3, 128, 128), as_strings=False, print_per_layer_stat=False)
-    print(f"Model FLOPs: {flops:e}")
+        print(f"\n{name} (batch {batch_size}):")
+        prof.print_table(top=top)
+        if trace_dir is not None:
+            prof.export_chrome_trace(os.path.join(trace_dir, f"{name}_trace.json"))
+        profilers[name] = prof
+    return profilers
 
-    # Return all metrics for comparison
+if __name__ == "__main__":
+    module_profiles = profile_mhist_models(trace_dir=data_path)
+
+
+"""INT8 CPU inference"""
+
+def quantize_dynamic_int8(model):
+    """Copy of the model with every nn.Linear (classifier head, Mamba projections) dynamically quantized to INT8."""
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(copy.deepcopy(model).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+def quantize_static_int8(model, calibration_loader, num_batches=10, backend='x86'):
+    """Copy of the model with the ResNet18 conv trunk statically quantized after a calibration pass.
+
+    The backbone is quantized with FX graph mode using activation ranges observed
+    on calibration_loader; the Linear layers are then dynamically quantized as in
+    quantize_dynamic_int8. LayerNorm, GELU and the Mamba scan stay in fp32.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    if isinstance(model, BaselineModel):
+        # Keep the fc head (LayerNorm/GELU) out of static quantization
+        qconfig_mapping.set_module_name('fc', None)
+        trunk_name = 'resnet'
+    else:
+        trunk_name = 'backbone'
+    trunk = getattr(model, trunk_name)
+
+    example_inputs = (next(iter(calibration_loader))[0],)
+    prepared = prepare_fx(trunk, qconfig_mapping, example_inputs)
+    with torch.no_grad():
+        for i, (images, _) in enumerate(calibration_loader):
+            if i >= num_batches:
+                break
+            prepared(images)
+    setattr(model, trunk_name, convert_fx(prepared))
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def model_size_mb(model):
+    """Serialized state_dict size."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+def evaluate_inference(model, loader):
+    """Accuracy, macro F1 and per-batch latency of an eval-mode model on CPU."""
+    model.eval()
+    all_preds, all_labels, latencies = [], [], []
+    with torch.no_grad():
+        for images, labels in loader:
+            start_time = time.perf_counter()
+            outputs = model(images)
+            latencies.append((time.perf_counter() - start_time) * 1000)
+            all_preds.append(outputs.argmax(dim=1))
+            all_labels.append(labels)
+
+    from sklearn.metrics import precision_recall_fscore_support
+    all_preds = torch.cat(all_preds).numpy()
+    all_labels = torch.cat(all_labels).numpy()
+    _, _, f1, _ = precision_recall_fscore_support(all_labels, all_preds, labels=[0, 1], average='macro', zero_division=0)
     return {
-        'test_loss': avg_test_loss,
-        'accuracy': accuracy,
-        'precision': precision,
-        'recall': recall,
+        'accuracy': 100 * (all_preds == all_labels).mean(),
         'f1': f1,
-        'training_time': training_time,
-        'testing_time': testing_time,
-        'flops': flops,
-        'confusion_matrix': confusion_matrix(all_labels, all_preds),
-        'training_history': {
-            'losses': training_losses,
-            'accuracies': training_accuracies
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p99_ms': float(np.percentile(latencies, 99)),
+        'samples_per_sec': len(all_labels) / (sum(latencies) / 1000),
+    }
+
+def quantization_report(model, annotations_file, img_dir, packed_dir=None, batch_size=16, num_calibration_batches=10):
+    """Compare fp32, dynamic INT8 and static INT8 variants of a trained model on the MHIST test partition."""
+    train_dataset, test_dataset = mhist_datasets(annotations_file, img_dir, packed_dir)
+    calibration_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=2)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=2)
+
+    model = model.cpu().eval()
+    variants = {
+        'fp32': model,
+        'dynamic_int8': quantize_dynamic_int8(model),
+        'static_int8': quantize_static_int8(model, calibration_loader, num_calibration_batches),
+    }
+
+    rows = []
+    for name, variant in variants.items():
+        row = {'variant': name, 'size_mb': model_size_mb(variant), **evaluate_inference(variant, test_loader)}
+        rows.append(row)
+        print(f"{type(model).__name__} {name}: accuracy {row['accuracy']:.2f}%, F1 {row['f1']:.4f}, "
+              f"p50 {row['latency_p50_ms']:.1f}ms/batch, {row['samples_per_sec']:.1f} samples/s, "
+              f"size {row['size_mb']:.1f}MB")
+    return rows
+
+if __name__ == "__main__":
+    quantization_rows = quantization_report(metrics['model'], annotations_file, img_dir)
+
+
+"""Micro-batching inference server"""
+
+MODEL_CLASSES = {'BaselineModel': BaselineModel, 'HybridModel': HybridModel, 'TokenHybridModel': TokenHybridModel}
+
+def save_model_checkpoint(model, path):
+    """Save a trained BaselineModel/HybridModel with enough metadata to rebuild it."""
+    torch.save({'model_class': type(model).__name__, 'num_classes': len(MHIST_CLASSES),
+                'model_kwargs': getattr(model, 'config', {}), 'state_dict': model.state_dict()}, path)
+
+def load_model_checkpoint(path):
+    checkpoint = torch.load(path, map_location='cpu')
+    model = MODEL_CLASSES[checkpoint['model_class']](num_classes=checkpoint['num_classes'], pretrained=False,
+                                                     **checkpoint.get('model_kwargs', {}))
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.eval()
+
+class MHISTInferenceServer:
+    """Local HTTP inference service that forms dynamic batches from concurrent requests.
+
+    POST /predict with an encoded image as the body returns the predicted label and
+    class probabilities; GET /stats returns throughput and latency counters.
+    Requests are queued and grouped into batches of up to max_batch_size, waiting
+    at most max_wait_ms after the first request of a batch. Decoding and model
+    execution run on a thread pool so the event loop only moves bytes.
+    """
+    def __init__(self, model, host='127.0.0.1', port=8080, max_batch_size=16, max_wait_ms=5, num_workers=2):
+        self.model = model.cpu().eval()
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.transform = mhist_transform()
+        self.latencies_ms = collections.deque(maxlen=10000)
+        self.num_requests = 0
+        self.num_batches = 0
+        self._loop = None
+        self._thread = None
+        self._batch_tasks = set()
+
+    # Request handling
+
+    def _preprocess(self, body):
+        return self.transform(Image.open(io.BytesIO(body)).convert("RGB"))
+
+    def _predict(self, images):
+        with torch.no_grad():
+            return F.softmax(self.model(torch.stack(images)), dim=1)
+
+    async def _batcher(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.num_batches += 1
+            # Do not wait for the result so the next batch can form while this one runs; the loop
+            # only keeps weak references to tasks, so hold on to it until it finishes
+            task = self._loop.create_task(self._run_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch):
+        images, futures = zip(*batch)
+        try:
+            probabilities = await self._loop.run_in_executor(self.executor, self._predict, list(images))
+        except Exception as exc:
+            for future in futures:
+                future.set_exception(exc)
+            return
+        for future, probs in zip(futures, probabilities.tolist()):
+            future.set_result(probs)
+
+    async def _handle_predict(self, body):
+        start_time = time.perf_counter()
+        image = await self._loop.run_in_executor(self.executor, self._preprocess, body)
+        future = self._loop.create_future()
+        await self._queue.put((image, future))
+        probabilities = await future
+        self.latencies_ms.append((time.perf_counter() - start_time) * 1000)
+        self.num_requests += 1
+        label = int(np.argmax(probabilities))
+        return {'label': MHIST_CLASSES[label], 'probabilities': probabilities}
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._start_time
+        latencies = list(self.latencies_ms) or [0.0]
+        return {
+            'requests': self.num_requests,
+            'batches': self.num_batches,
+            'mean_batch_size': self.num_requests / max(self.num_batches, 1),
+            'throughput_rps': self.num_requests / elapsed,
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p99_ms': float(np.percentile(latencies, 99)),
         }
+
+    async def _read_request(self, reader):
+        """(method, path, body) of the next request, None at end of stream; ValueError if malformed."""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode().split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode().split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        content_length = int(headers.get('content-length', 0))
+        if content_length < 0:
+            raise ValueError(f"negative Content-Length {content_length}")
+        return method, path, await reader.readexactly(content_length)
+
+    async def _respond(self, writer, status, payload):
+        data = json.dumps(payload).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+        await writer.drain()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except ValueError as exc:
+                    # Malformed request line, header or Content-Length: the stream cannot be resynced
+                    await self._respond(writer, '400 Bad Request', {'error': f'malformed request: {exc}'})
+                    break
+                if request is None:
+                    break
+                method, path, body = request
+
+                if method == 'POST' and path == '/predict':
+                    try:
+                        status, payload = '200 OK', await self._handle_predict(body)
+                    except Exception as exc:
+                        status, payload = '400 Bad Request', {'error': str(exc)}
+                elif method == 'GET' and path == '/stats':
+                    status, payload = '200 OK', self.stats()
+                else:
+                    status, payload = '404 Not Found', {'error': f'no route for {method} {path}'}
+                await self._respond(writer, status, payload)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    # Lifecycle
+
+    async def _serve(self):
+        self._queue = asyncio.Queue()
+        self._start_time = time.perf_counter()
+        self._batcher_task = self._loop.create_task(self._batcher())
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        """Run the server on a background thread; returns once it is accepting connections."""
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._serve())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        print(f"Serving {type(self.model).__name__} on http://{self.host}:{self.port}")
+        return self
+
+    async def _shutdown(self):
+        self._server.close()
+        self._batcher_task.cancel()
+        try:
+            await self._batcher_task
+        except asyncio.CancelledError:
+            pass
+        # Let in-flight batches resolve their requests before the loop and executor go away
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self.executor.shutdown()
+
+def synthetic_image_bytes(num_images=32, size=(224, 224), seed=0):
+    """Random PNG-encoded RGB images so the load generator can run without the dataset."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(num_images):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (size[0], size[1], 3), dtype=np.uint8)).save(buffer, format='PNG')
+        images.append(buffer.getvalue())
+    return images
+
+def run_load_generator(host='127.0.0.1', port=8080, images=None, num_requests=512, concurrency=32):
+    """Send POST /predict requests from concurrent keep-alive clients and report client-side latency."""
+    images = images or synthetic_image_bytes()
+
+    async def client(client_id, num_client_requests, latencies):
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in range(num_client_requests):
+            body = images[(client_id + i * concurrency) % len(images)]
+            start_time = time.perf_counter()
+            writer.write(f"POST /predict HTTP/1.1\r\nHost: {host}\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            await reader.readline()
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                key, value = line.decode().split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers['content-length']))
+            latencies.append((time.perf_counter() - start_time) * 1000)
+        writer.close()
+
+    async def run():
+        latencies = []
+        per_client = [num_requests // concurrency + (i < num_requests % concurrency) for i in range(concurrency)]
+        start_time = time.perf_counter()
+        await asyncio.gather(*(client(i, n, latencies) for i, n in enumerate(per_client)))
+        elapsed = time.perf_counter() - start_time
+        return {
+            'requests': len(latencies),
+            'throughput_rps': len(latencies) / elapsed,
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p99_ms': float(np.percentile(latencies, 99)),
+        }
+
+    results = asyncio.run(run())
+    print(f"Load generator: {results['requests']} requests, {results['throughput_rps']:.1f} req/s, "
+          f"p50 {results['latency_p50_ms']:.1f}ms, p99 {results['latency_p99_ms']:.1f}ms")
+    return results
+
+if __name__ == "__main__":
+    checkpoint_path = os.path.join(data_path, "hybrid_model.pt")
+    save_model_checkpoint(metrics['model'], checkpoint_path)
+    server = MHISTInferenceServer(load_model_checkpoint(checkpoint_path), port=0).start()
+    load_results = run_load_generator(port=server.port)
+    print(server.stats())
+    server.stop()
+
+
+"""Multi-process data-parallel training on CPU"""
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _ddp_worker(rank, world_size, port, model_name, annotations_file, img_dir, packed_dir, num_epochs, batch_size,
+                lr, threads_per_rank, result_queue):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(threads_per_rank)
+    torch.manual_seed(0)
+    device = torch.device('cpu')
+
+    # Each rank trains on its own shard; the test set is split without padding so no sample is counted twice
+    train_dataset, test_dataset = mhist_datasets(annotations_file, img_dir, packed_dir)
+    sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=0)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=sampler)
+    test_loader = DataLoader(Subset(test_dataset, range(rank, len(test_dataset), world_size)), batch_size=batch_size)
+
+    model = MODEL_CLASSES[model_name](num_classes=len(MHIST_CLASSES))
+    ddp_model = DDP(model)
+    criterion = nn.CrossEntropyLoss(label_smoothing=0.1)
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+
+    history = {'losses': [], 'accuracies': [], 'samples_per_sec': []}
+    training_start_time = time.time()
+    for epoch in range(num_epochs):
+        sampler.set_epoch(epoch)
+        dist.barrier()
+        epoch_start_time = time.time()
+        epoch_loss, correct, total = train_one_epoch(ddp_model, model, train_loader, optimizer, criterion, device)
+        epoch_time = torch.tensor([time.time() - epoch_start_time])
+
+        # Sum loss/correct/total over ranks; the slowest rank sets the epoch time
+        totals = torch.tensor([epoch_loss.item(), correct.item(), total, len(train_loader)], dtype=torch.float64)
+        dist.all_reduce(totals)
+        dist.all_reduce(epoch_time, op=dist.ReduceOp.MAX)
+        history['losses'].append(totals[0].item() / totals[3].item())
+        history['accuracies'].append(100 * totals[1].item() / totals[2].item())
+        history['samples_per_sec'].append(totals[2].item() / epoch_time.item())
+        if rank == 0:
+            print(f"Epoch {epoch+1}: Loss = {history['losses'][-1]:.4f}, Accuracy = {history['accuracies'][-1]:.2f}%, "
+                  f"Throughput = {history['samples_per_sec'][-1]:.1f} samples/s ({world_size} processes)")
+    training_time = time.time() - training_start_time
+
+    # Gather per-rank predictions for one classification report
+    preds, labels, test_loss = predict(model, model, test_loader, criterion, device)
+    gathered = [None] * world_size
+    dist.all_gather_object(gathered, (preds, labels, test_loss.item(), len(test_loader)))
+
+    if rank == 0:
+        from sklearn.metrics import confusion_matrix, classification_report, precision_recall_fscore_support
+        all_preds = np.concatenate([g[0] for g in gathered])
+        all_labels = np.concatenate([g[1] for g in gathered])
+        precision, recall, f1, _ = precision_recall_fscore_support(all_labels, all_preds, labels=[0, 1], average=None)
+        print("\nDetailed Classification Report:")
+        print(classification_report(all_labels, all_preds, target_names=MHIST_CLASSES, digits=4))
+        result_queue.put({
+            'world_size': world_size,
+            'test_loss': sum(g[2] for g in gathered) / sum(g[3] for g in gathered),
+            'accuracy': 100 * (all_preds == all_labels).mean(),
+            'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'training_time': training_time,
+            'confusion_matrix': confusion_matrix(all_labels, all_preds),
+            'training_history': history,
+        })
+    dist.destroy_process_group()
+
+def train_distributed(annotations_file, img_dir, model_name='HybridModel', world_size=2, num_epochs=10,
+                      batch_size=16, lr=0.0003, packed_dir=None, threads_per_rank=None):
+    """Train with DistributedDataParallel over world_size CPU processes (gloo backend).
+
+    batch_size is per process, so the global batch is batch_size * world_size.
+    Workers are forked so functions defined in the notebook are available to them.
+    Returns the rank-0 metrics, with the test report built from all ranks' shards.
+    """
+    threads_per_rank = threads_per_rank or max(1, (os.cpu_count() or 1) // world_size)
+    if packed_dir is not None:
+        # Pack a missing store once here; ranks packing concurrently would race on the same tmp files
+        mhist_datasets(annotations_file, img_dir, packed_dir)
+    result_queue = mp.get_context('fork').SimpleQueue()
+    mp.start_processes(_ddp_worker, nprocs=world_size, start_method='fork',
+                       args=(world_size, _free_port(), model_name, annotations_file, img_dir, packed_dir,
+                             num_epochs, batch_size, lr, threads_per_rank, result_queue))
+    return result_queue.get()
+
+def ddp_scaling_benchmark(annotations_file, img_dir, process_counts=(1, 2, 4), model_name='HybridModel',
+                          num_epochs=2, packed_dir=None, chart_path=None):
+    """Training samples/s versus number of DDP processes, optionally saved as a chart."""
+    rows = []
+    for world_size in process_counts:
+        result = train_distributed(annotations_file, img_dir, model_name=model_name, world_size=world_size,
+                                   num_epochs=num_epochs, packed_dir=packed_dir)
+        # Skip the first epoch when possible; it includes process and loader warm-up
+        throughput = result['training_history']['samples_per_sec'][1:] or result['training_history']['samples_per_sec']
+        rows.append({'world_size': world_size, 'samples_per_sec': sum(throughput) / len(throughput)})
+        print(f"{world_size} processes: {rows[-1]['samples_per_sec']:.1f} samples/s")
+
+    if chart_path is not None:
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(5, 4))
+        plt.plot([r['world_size'] for r in rows], [r['samples_per_sec'] for r in rows], marker='o')
+        plt.xlabel('Processes')
+        plt.ylabel('Training samples/s')
+        plt.title(f'{model_name} DDP scaling (CPU, gloo)')
+        plt.grid(True)
+        plt.savefig(chart_path, bbox_inches='tight')
+        plt.close()
+    return rows
+
+if __name__ == "__main__":
+    scaling_rows = ddp_scaling_benchmark(annotations_file, img_dir, chart_path=os.path.join(data_path, "ddp_scaling.png"))
+
+"""Checkpointing overhead"""
+
+def measure_checkpoint_overhead(model_name='HybridModel', checkpoint_every=(10, 1), num_steps=40, batch_size=16,
+                                image_size=128, checkpoint_dir=None, device='cpu'):
+    """Mean training step time with checkpointing off, async and synchronous.
+
+    Trains on random images so the numbers only reflect compute and checkpoint
+    cost. 'async' uses AsyncCheckpointer (the step only waits for the CPU copy),
+    'sync' calls torch.save inline for comparison.
+    """
+    import tempfile
+    checkpoint_dir = checkpoint_dir or tempfile.mkdtemp()
+    checkpoint_path = os.path.join(checkpoint_dir, 'overhead.pt')
+    device = torch.device(device)
+    dataset = torch.utils.data.TensorDataset(torch.randn(num_steps * batch_size, 3, image_size, image_size),
+                                             torch.randint(len(MHIST_CLASSES), (num_steps * batch_size,)))
+    loader = make_train_loader(dataset, batch_size, seed=0)
+    model = MODEL_CLASSES[model_name](num_classes=len(MHIST_CLASSES), pretrained=False).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=0.0003)
+    criterion = nn.CrossEntropyLoss(label_smoothing=0.1)
+
+    def run(mode, every):
+        checkpointer = AsyncCheckpointer(checkpoint_path) if mode == 'async' else None
+        step_times = []
+        last = [time.perf_counter()]
+
+        def on_step(step, epoch_loss, correct, total):
+            if mode != 'off' and step % every == 0:
+                state = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'rng': rng_state()}
+                if checkpointer is not None:
+                    checkpointer.save(state)
+                else:
+                    torch.save(state, checkpoint_path)
+            now = time.perf_counter()
+            step_times.append(now - last[0])
+            last[0] = now
+
+        train_one_epoch(model, model, loader, optimizer, criterion, device, on_step=on_step)
+        if checkpointer is not None:
+            checkpointer.close()
+        # Drop the first steps (allocator and thread pool warm-up)
+        return 1000 * float(np.mean(step_times[2:]))
+
+    run('off', None)
+    baseline_ms = run('off', None)
+    rows = [{'mode': 'off', 'checkpoint_every': None, 'step_ms': baseline_ms, 'overhead_pct': 0.0}]
+    for every in checkpoint_every:
+        for mode in ('async', 'sync'):
+            step_ms = run(mode, every)
+            rows.append({'mode': mode, 'checkpoint_every': every, 'step_ms': step_ms,
+                         'overhead_pct': 100 * (step_ms / baseline_ms - 1)})
+
+    size_mb = os.path.getsize(checkpoint_path) / 2**20
+    print(f"{model_name}, batch {batch_size}, checkpoint {size_mb:.1f} MB")
+    for row in rows:
+        every = row['checkpoint_every'] or '-'
+        print(f"{row['mode']:>5}  every {every!s:>3} steps: {row['step_ms']:8.2f} ms/step ({row['overhead_pct']:+.1f}%)")
+    return rows
+
+if __name__ == "__main__":
+    overhead_rows = measure_checkpoint_overhead()
+    metrics = train_hybrid_model(annotations_file, img_dir, checkpoint_path=os.path.join(data_path, "hybrid_checkpoint.pt"),
+                                 checkpoint_every=50, resume=True)
+
+"""Hyperparameter sweep"""
+
+SWEEP_KEYS = ('d_state', 'expand', 'dt_rank', 'd_conv', 'lr')
+
+class SharedMHISTDataset(Dataset):
+    """Decoded uint8 (N, 3, H, W) images held in shared memory.
+
+    Built once in the parent; forked trial processes map the same pages, so
+    every trial reads one read-only copy instead of decoding MHIST again.
+    """
+    def __init__(self, images, labels, transform=None):
+        self.images = images.share_memory_()
+        self.labels = labels.share_memory_()
+        self.transform = transform
+
+    @classmethod
+    def from_partition(cls, annotations_file, img_dir, partition, packed_dir=None, transform=None):
+        if packed_dir is not None:
+            if not os.path.exists(os.path.join(packed_dir, f"{partition}_images.npy")):
+                pack_mhist_partition(annotations_file, img_dir, partition, packed_dir)
+            packed = PackedMHISTDataset(packed_dir, partition)
+            images = torch.from_numpy(np.array(packed.images)).permute(0, 3, 1, 2).contiguous()
+            return cls(images, packed.labels.clone(), transform)
+
+        dataset = MHISTDataset(annotations_file, img_dir, partition=partition, transform=transforms.Resize((128, 128)))
+        images = torch.empty(len(dataset), 3, 128, 128, dtype=torch.uint8)
+        labels = torch.empty(len(dataset), dtype=torch.long)
+        for idx in range(len(dataset)):
+            image, labels[idx] = dataset[idx]
+            images[idx] = torch.from_numpy(np.asarray(image, dtype=np.uint8)).permute(2, 0, 1)
+        return cls(images, labels, transform)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        image = self.images[idx]
+        if self.transform:
+            image = self.transform(image)
+        return image, self.labels[idx]
+
+def sweep_trials(search_space, num_trials=None, seed=0):
+    """Configs from a {name: [values]} search space: the full grid, or num_trials random grid points."""
+    names = list(search_space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(search_space[name] for name in names))]
+    if num_trials is not None and num_trials < len(grid):
+        generator = torch.Generator().manual_seed(seed)
+        grid = [grid[idx] for idx in torch.randperm(len(grid), generator=generator)[:num_trials].tolist()]
+    return grid
+
+_SWEEP_STATE = {}
+
+def _sweep_worker_init(train_dataset, val_dataset, core_queue):
+    # Pin this worker to its own cores so concurrent trials do not oversubscribe
+    cores = core_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    _SWEEP_STATE.update(train_dataset=train_dataset, val_dataset=val_dataset)
+
+def _sweep_trial(trial_id, config, num_epochs, batch_size, sweep_dir, seed):
+    torch.manual_seed(seed + trial_id)
+    model_kwargs = {key: value for key, value in config.items() if key != 'lr'}
+    model = HybridModel(num_classes=len(MHIST_CLASSES), **model_kwargs)
+    train_loader = make_train_loader(_SWEEP_STATE['train_dataset'], batch_size, seed=seed + trial_id)
+    val_loader = DataLoader(_SWEEP_STATE['val_dataset'], batch_size=batch_size, shuffle=False)
+
+    # Each rung resumes from the trial's checkpoint, so only the extra epochs are trained
+    with open(os.path.join(sweep_dir, f"trial_{trial_id}.log"), 'a') as log, contextlib.redirect_stdout(log):
+        metrics = train_model(model, train_loader, val_loader, num_epochs=num_epochs, lr=config.get('lr', 0.0003),
+                              device='cpu', checkpoint_path=os.path.join(sweep_dir, f"trial_{trial_id}.pt"),
+                              resume=True)
+    return {
+        'trial': trial_id,
+        **config,
+        'epochs': num_epochs,
+        'val_accuracy': metrics['accuracy'],
+        'val_f1': float(np.mean(metrics['f1'])),
+        'train_time': metrics['training_time'],
+        'flops': metrics['flops'],
     }
 
+def run_sweep(annotations_file, img_dir, search_space, num_trials=None, packed_dir=None, max_workers=2,
+              threads_per_trial=None, min_epochs=1, max_epochs=9, eta=3, val_fraction=0.2, batch_size=16,
+              sweep_dir=None, seed=0):
+    """Successive-halving sweep over HybridModel Mamba settings and learning rate.
+
+    search_space maps any of SWEEP_KEYS to a list of values. All trials train
+    for min_epochs, then the best 1/eta (by validation accuracy, ties broken by
+    F1) continue to eta times the budget, and so on up to max_epochs. Trials run
+    in a pool of max_workers forked processes, each pinned to threads_per_trial
+    cores, and share one decoded copy of the training partition; a held-out
+    val_fraction of it is used for selection so the test set stays untouched.
+    Trial checkpoints and logs (trial_*.pt, trial_*.log in sweep_dir) from an
+    earlier sweep are removed at the start; rungs resume only within this sweep.
+    Returns one row per trial with the metrics from the last rung it reached.
+    """
+    unknown = set(search_space) - set(SWEEP_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters {sorted(unknown)}; expected a subset of {SWEEP_KEYS}")
+    sweep_dir = sweep_dir or os.path.join(data_path, "sweep")
+    os.makedirs(sweep_dir, exist_ok=True)
+    # Trial ids restart at 0, so a previous sweep's checkpoints would be resumed with the wrong config
+    for name in os.listdir(sweep_dir):
+        if name.startswith("trial_") and name.endswith((".pt", ".log")):
+            os.remove(os.path.join(sweep_dir, name))
+
+    dataset = SharedMHISTDataset.from_partition(annotations_file, img_dir, 'train', packed_dir, packed_transform())
+    order = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(seed)).tolist()
+    num_val = int(len(dataset) * val_fraction)
+    val_dataset, train_dataset = Subset(dataset, order[:num_val]), Subset(dataset, order[num_val:])
+
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    threads_per_trial = threads_per_trial or max(1, len(cpus) // max_workers)
+    context = mp.get_context('fork')
+    core_queue = context.Queue()
+    for worker in range(max_workers):
+        # Wrap around when there are fewer cores than workers * threads_per_trial
+        core_queue.put({cpus[(worker * threads_per_trial + i) % len(cpus)] for i in range(threads_per_trial)})
+
+    trials = dict(enumerate(sweep_trials(search_space, num_trials, seed)))
+    results = {}
+    survivors = list(trials)
+    budget = min_epochs
+    print(f"Sweep: {len(trials)} trials, {max_workers} workers x {threads_per_trial} threads, eta={eta}")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_sweep_worker_init,
+                             initargs=(train_dataset, val_dataset, core_queue)) as executor:
+        while True:
+            futures = [executor.submit(_sweep_trial, trial_id, trials[trial_id], budget, batch_size, sweep_dir, seed)
+                       for trial_id in survivors]
+            for future in futures:
+                row = future.result()
+                # train_model only reports the time of the epochs it ran in this rung
+                row['train_time'] += results.get(row['trial'], {}).get('train_time', 0.0)
+                results[row['trial']] = row
+
+            ranked = sorted(survivors, key=lambda t: (results[t]['val_accuracy'], results[t]['val_f1']), reverse=True)
+            print(f"Rung at {budget} epochs: " + ", ".join(
+                f"trial {t} {results[t]['val_accuracy']:.1f}%" for t in ranked))
+            if budget >= max_epochs or len(ranked) == 1:
+                break
+            survivors = ranked[:max(1, len(ranked) // eta)]
+            for trial_id in ranked[len(survivors):]:
+                os.remove(os.path.join(sweep_dir, f"trial_{trial_id}.pt"))
+            budget = min(budget * eta, max_epochs)
+
+    table = pd.DataFrame(list(results.values()))
+    table = table.sort_values(['epochs', 'val_accuracy', 'val_f1'], ascending=False).reset_index(drop=True)
+    print(table.to_string(index=False))
+    return table
+
 if __name__ == "__main__":
-    annotations_file = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/annotations.csv"
-    img_dir = "/content/gdrive/MyDrive/submission_files1/mhist_dataset/images"
-    metrics = train_hybrid_model(annotations_file, img_dir)
\ No newline at end of file
+    sweep_table = run_sweep(annotations_file, img_dir,
+                            {'d_state': [8, 16], 'expand': [1.0, 2.0], 'dt_rank': [8, 16], 'lr': [0.0003, 0.001]},
+                            num_trials=9, packed_dir=os.path.join(data_path, "packed"))
+    sweep_table.to_csv(os.path.join(data_path, "sweep_results.csv"), index=False)
+
+"""Token-sequence hybrid: latency and FLOPs per token count"""
+
+DEFAULT_TOKEN_CONFIGS = [
+    {'feature_layer': 'layer4', 'token_grid': 1},
+    {'feature_layer': 'layer4', 'token_grid': 2},
+    {'feature_layer': 'layer4'},
+    {'feature_layer': 'layer3', 'token_grid': 4},
+    {'feature_layer': 'layer3'},
+    {'feature_layer': 'layer3', 'scan_order': 'snake', 'bidirectional': True},
+]
+
+def _count_flops(fn, *args):
+    from torch.utils.flop_counter import FlopCounterMode
+    with FlopCounterMode(display=False) as counter:
+        fn(*args)
+    return counter.get_total_flops()
+
+def _scan_flops(model, fn, *args):
+    """FLOPs _count_flops attributes to the selective scans of model's Mamba layers during fn(*args).
+
+    These are the scan implementation's own matmuls (e.g. selective_scan's
+    block-triangular prefix sums), not work the model defines.
+    """
+    scan_inputs = []
+    hooks = [module.register_forward_pre_hook(lambda module, inputs: scan_inputs.append((module, inputs[0])))
+             for module in model.modules() if isinstance(module, Mamba)]
+    try:
+        fn(*args)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    flops = 0
+    for module, x in scan_inputs:
+        x, _, dt, A, B, C = module._ssm_inputs(x)
+        flops += _count_flops(getattr(module, f"_scan_{module.scan_impl}"), x, dt, A, B, C)
+    return flops
+
+def benchmark_token_hybrid(configs=DEFAULT_TOKEN_CONFIGS, batch_size=1, image_size=128, repeats=10, warmup=2):
+    """Forward latency and FLOPs of TokenHybridModel per token count, next to the pooled HybridModel.
+
+    head_ms / head_gflops cover LayerNorm -> Mamba -> classifier on the token
+    sequence, i.e. what the SSM adds on top of the backbone. FLOPs count matmuls
+    and convolutions only. Whatever the selective scan itself counts depends on
+    its implementation rather than the model, so it is subtracted from gflops
+    and head_gflops and reported on its own as scan_gflops.
+    """
+    x = torch.randn(batch_size, 3, image_size, image_size)
+
+    def timed(fn, *args):
+        for _ in range(warmup):
+            fn(*args)
+        times = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            fn(*args)
+            times.append(time.perf_counter() - start_time)
+        return 1000 * float(np.median(times))
+
+    models = [('HybridModel', {}, HybridModel(num_classes=len(MHIST_CLASSES), pretrained=False))]
+    models += [('TokenHybridModel', config, TokenHybridModel(num_classes=len(MHIST_CLASSES), pretrained=False, **config))
+               for config in configs]
+
+    rows = []
+    with torch.no_grad():
+        for name, config, model in models:
+            model.eval()
+            features = model.forward_features(x)
+            scan_flops = _scan_flops(model, model.forward_head, features)
+            rows.append({
+                'model': name,
+                'feature_layer': config.get('feature_layer', 'pooled'),
+                'tokens': features.shape[1] if features.dim() == 3 else 1,
+                'scan_order': config.get('scan_order', 'row'),
+                'bidirectional': config.get('bidirectional', False),
+                'total_ms': timed(model, x),
+                'head_ms': timed(model.forward_head, features),
+                'gflops': (_count_flops(model, x) - scan_flops) / 1e9,
+                'head_gflops': (_count_flops(model.forward_head, features) - scan_flops) / 1e9,
+                'scan_gflops': scan_flops / 1e9,
+            })
+            row = rows[-1]
+            print(f"{name:>16} {row['feature_layer']:>7} {row['tokens']:>4} tokens {row['scan_order']:>6}"
+                  f"{' bidir' if row['bidirectional'] else '      '}: {row['total_ms']:7.2f} ms "
+                  f"(head {row['head_ms']:6.2f} ms), {row['gflops']:.3f} GFLOPs (head {row['head_gflops']:.4f}, "
+                  f"scan {row['scan_gflops']:.4f})")
+    return rows
+
+if __name__ == "__main__":
+    token_rows = benchmark_token_hybrid()
+    train_dataset, test_dataset = mhist_datasets(annotations_file, img_dir)
+    token_metrics = train_model(TokenHybridModel(num_classes=len(MHIST_CLASSES), feature_layer='layer3'),
+                                make_train_loader(train_dataset, 16, num_workers=2),
+                                DataLoader(test_dataset, batch_size=16, num_workers=2))
+
+"""Whole-slide tiled inference"""
+
+class NumpySlide:
+    """Slide stored as a uint8 (H, W, 3) .npy file, read region by region with pread.
+
+    Regions are read straight from the file into fresh buffers rather than
+    through a memory map, so pages already processed do not stay resident.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            self.offset = f.tell()
+        if fortran_order or dtype != np.uint8 or len(shape) != 3 or shape[2] != 3:
+            raise ValueError(f"{path} must hold a C-ordered uint8 (H, W, 3) array, got {dtype} {shape}")
+        self.height, self.width = shape[:2]
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read_region(self, x, y, width, height):
+        height = min(height, self.height - y)
+        row_bytes = self.width * 3
+        if x == 0 and width == self.width:
+            data = os.pread(self.fd, height * row_bytes, self.offset + y * row_bytes)
+            return np.frombuffer(data, dtype=np.uint8).reshape(height, self.width, 3)
+        width = min(width, self.width - x)
+        region = np.empty((height, width, 3), dtype=np.uint8)
+        for row in range(height):
+            data = os.pread(self.fd, width * 3, self.offset + (y + row) * row_bytes + x * 3)
+            region[row] = np.frombuffer(data, dtype=np.uint8).reshape(width, 3)
+        return region
+
+    def close(self):
+        os.close(self.fd)
+
+class OpenSlideSlide:
+    """Level-0 regions of a whole-slide image file (.svs, .tiff, .ndpi, ...) via openslide."""
+    def __init__(self, path):
+        import openslide
+        self.slide = openslide.OpenSlide(path)
+        self.width, self.height = self.slide.dimensions
+
+    def read_region(self, x, y, width, height):
+        width, height = min(width, self.width - x), min(height, self.height - y)
+        return np.asarray(self.slide.read_region((x, y), 0, (width, height)).convert('RGB'))
+
+    def close(self):
+        self.slide.close()
+
+def open_slide(path):
+    return NumpySlide(path) if path.endswith('.npy') else OpenSlideSlide(path)
+
+def make_synthetic_slide(path, height=16384, width=16384, num_blobs=40, seed=0, band_rows=1024):
+    """Write a slide-like uint8 .npy (white background, textured pink/purple tissue blobs) band by band."""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform([0, 0], [height, width], size=(num_blobs, 2))
+    radii = rng.uniform(0.03, 0.12, size=(num_blobs, 2)) * min(height, width)
+    slide = np.lib.format.open_memmap(path + ".tmp.npy", mode='w+', dtype=np.uint8, shape=(height, width, 3))
+    cols = np.arange(width)
+    for y in range(0, height, band_rows):
+        rows = np.arange(y, min(y + band_rows, height))[:, None]
+        tissue = np.zeros((len(rows), width), dtype=bool)
+        for (cy, cx), (ry, rx) in zip(centers, radii):
+            if abs(cy - y) < ry + band_rows:
+                tissue |= ((rows - cy) / ry) ** 2 + ((cols - cx) / rx) ** 2 < 1
+        band = rng.normal(242, 4, size=(len(rows), width, 3))
+        stain = np.array([200, 120, 190]) + rng.normal(0, 25, size=(len(rows), width, 3))
+        band[tissue] = stain[tissue]
+        slide[y:y + len(rows)] = band.clip(0, 255).astype(np.uint8)
+    slide.flush()
+    del slide
+    os.replace(path + ".tmp.npy", path)
+    return path
+
+def tissue_fraction(tiles, stride=8):
+    """Cheap per-tile tissue estimate on a strided subsample: share of pixels that are
+    not near-white and have some stain saturation (max - min over RGB)."""
+    sample = tiles[:, ::stride, ::stride].astype(np.int16)
+    saturation = sample.max(axis=-1) - sample.min(axis=-1)
+    tissue = (saturation > 25) & (sample.mean(axis=-1) < 220)
+    return tissue.mean(axis=(1, 2))
+
+def slide_inference(model, slide_path, heatmap_path, tile_size=224, input_size=128, batch_size=32, min_tissue=0.25,
+                    device='cpu'):
+    """Classify a large image tile by tile and write a per-tile probability heatmap.
+
+    The slide is streamed one band of tile_size rows at a time, with the next
+    band read on a background thread while the current one is classified, so
+    memory stays at about two bands regardless of slide size. Tiles whose
+    tissue_fraction is below min_tissue are skipped. Tissue tiles are resized
+    to input_size, normalized like packed_transform() and batched through the
+    model. The heatmap is a float16 (rows, cols, num_classes) .npy with NaN
+    for background tiles. Returns tile counts and timings; tissue_tiles_per_sec
+    counts classified tiles only, scanned_tiles_per_sec includes background.
+    """
+    device = torch.device(device)
+    model = model.to(device).eval()
+    mean = torch.tensor(MHIST_MEAN, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(MHIST_STD, device=device).view(1, 3, 1, 1)
+    slide = open_slide(slide_path)
+    rows, cols = math.ceil(slide.height / tile_size), math.ceil(slide.width / tile_size)
+    tmp_path = heatmap_path + ".tmp.npy"
+
+    def read_band(row):
+        band = slide.read_region(0, row * tile_size, slide.width, tile_size)
+        if band.shape[0] < tile_size or band.shape[1] < cols * tile_size:
+            # Edge tiles are padded with white so they are treated like background
+            band = np.pad(band, ((0, tile_size - band.shape[0]), (0, cols * tile_size - band.shape[1]), (0, 0)),
+                          constant_values=255)
+        tiles = band.reshape(tile_size, cols, tile_size, 3).swapaxes(0, 1)
+        keep = np.flatnonzero(tissue_fraction(tiles) >= min_tissue)
+        return row, tiles[keep], keep
+
+    def classify(heatmap, batch, coords):
+        images = torch.from_numpy(np.stack(batch)).to(device).permute(0, 3, 1, 2).float().div_(255)
+        images = F.interpolate(images, size=(input_size, input_size), mode='bilinear', antialias=True,
+                               align_corners=False)
+        probs = F.softmax(model((images - mean) / std), dim=1).cpu().numpy()
+        heatmap[tuple(np.array(coords).T)] = probs
+
+    heatmap = None
+    try:
+        heatmap = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                            shape=(rows, cols, len(MHIST_CLASSES)))
+        heatmap[:] = np.nan
+
+        start_time = time.perf_counter()
+        batch, coords, tissue_tiles = [], [], 0
+        with ThreadPoolExecutor(max_workers=1) as reader, torch.no_grad():
+            pending = reader.submit(read_band, 0)
+            for next_row in range(1, rows + 1):
+                row, tiles, keep = pending.result()
+                if next_row < rows:
+                    pending = reader.submit(read_band, next_row)
+                tissue_tiles += len(keep)
+                for tile, col in zip(tiles, keep):
+                    batch.append(tile)
+                    coords.append((row, col))
+                    if len(batch) == batch_size:
+                        classify(heatmap, batch, coords)
+                        batch, coords = [], []
+            if batch:
+                classify(heatmap, batch, coords)
+        elapsed = time.perf_counter() - start_time
+
+        heatmap.flush()
+        heatmap = None
+        os.replace(tmp_path, heatmap_path)
+    finally:
+        # Release the memmap before its file is removed on failure
+        heatmap = None
+        slide.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return {
+        'tiles': rows * cols,
+        'tissue_tiles': tissue_tiles,
+        'seconds': elapsed,
+        'tissue_tiles_per_sec': tissue_tiles / elapsed,
+        'scanned_tiles_per_sec': rows * cols / elapsed,
+    }
+
+def benchmark_slide_inference(model_name='BaselineModel', slide_size=16384, tile_size=224, batch_size=32, work_dir=None):
+    """Tiles/s and peak memory of slide_inference on a synthetic slide_size x slide_size image."""
+    import tempfile
+    work_dir = work_dir or tempfile.mkdtemp()
+    slide_path = os.path.join(work_dir, f"synthetic_slide_{slide_size}.npy")
+    if not os.path.exists(slide_path):
+        make_synthetic_slide(slide_path, slide_size, slide_size)
+    model = MODEL_CLASSES[model_name](num_classes=len(MHIST_CLASSES), pretrained=False)
+
+    with PeakRSSMonitor() as monitor:
+        result = slide_inference(model, slide_path, os.path.join(work_dir, "heatmap.npy"), tile_size=tile_size,
+                                 batch_size=batch_size)
+    result.update(model=model_name, slide_mb=os.path.getsize(slide_path) / 2**20,
+                  peak_rss_mb=monitor.peak / 2**20, peak_rss_delta_mb=(monitor.peak - monitor.start) / 2**20)
+    print(f"{model_name}: {result['tiles']} tiles ({result['tissue_tiles']} tissue) in {result['seconds']:.1f}s, "
+          f"{result['tissue_tiles_per_sec']:.1f} tissue tiles/s ({result['scanned_tiles_per_sec']:.1f} scanned tiles/s); "
+          f"slide {result['slide_mb']:.0f} MB, peak RSS {result['peak_rss_mb']:.0f} MB "
+          f"(+{result['peak_rss_delta_mb']:.0f} MB)")
+    return result
+
+if __name__ == "__main__":
+    slide_results = [benchmark_slide_inference(name) for name in ['BaselineModel', 'HybridModel']]
+
+"""Structured channel pruning"""
+
+def _basic_blocks(model):
+    from torchvision.models.resnet import BasicBlock
+    return [module for module in model.modules() if isinstance(module, BasicBlock)]
+
+def block_channel_importance(block):
+    """Importance of each inner channel of a BasicBlock: L1 norm of its conv1 filter
+    times the magnitude of the BN scale that follows (|gamma| / sqrt(var + eps))."""
+    bn = block.bn1
+    scale = (bn.weight / torch.sqrt(bn.running_var + bn.eps)).abs()
+    return block.conv1.weight.detach().abs().sum(dim=(1, 2, 3)) * scale.detach()
+
+def prune_basic_block(block, keep):
+    """Physically drop inner channels of a BasicBlock (conv1 outputs, bn1, conv2 inputs).
+
+    The block's input and output widths are untouched, so residual connections
+    and downsample branches stay valid and the result is a plain dense block.
+    """
+    keep = torch.as_tensor(keep, device=block.conv1.weight.device)
+    conv1, bn1, conv2 = block.conv1, block.bn1, block.conv2
+
+    new_conv1 = nn.Conv2d(conv1.in_channels, len(keep), conv1.kernel_size, conv1.stride, conv1.padding, bias=False)
+    new_conv1.weight.data = conv1.weight.data[keep].clone()
+    new_bn1 = nn.BatchNorm2d(len(keep), eps=bn1.eps, momentum=bn1.momentum)
+    for name in ['weight', 'bias']:
+        getattr(new_bn1, name).data = getattr(bn1, name).data[keep].clone()
+    for name in ['running_mean', 'running_var']:
+        setattr(new_bn1, name, getattr(bn1, name)[keep].clone())
+    new_bn1.num_batches_tracked = bn1.num_batches_tracked.clone()
+    new_conv2 = nn.Conv2d(len(keep), conv2.out_channels, conv2.kernel_size, conv2.stride, conv2.padding, bias=False)
+    new_conv2.weight.data = conv2.weight.data[:, keep].clone()
+
+    block.conv1, block.bn1, block.conv2 = (m.to(conv1.weight.device).train(block.training)
+                                           for m in (new_conv1, new_bn1, new_conv2))
+
+def prune_backbone(model, ratio, min_channels=8):
+    """Remove the least important ratio of inner channels from every BasicBlock.
+
+    Works on any model containing torchvision ResNet BasicBlocks (BaselineModel,
+    HybridModel, TokenHybridModel). Channel counts are kept at multiples of
+    min_channels, which CPU conv kernels handle best. Returns the inner widths.
+    """
+    widths = []
+    for block in _basic_blocks(model):
+        channels = block.conv1.out_channels
+        keep_count = max(min_channels, int(round(channels * (1 - ratio) / min_channels)) * min_channels)
+        if keep_count < channels:
+            keep = block_channel_importance(block).argsort(descending=True)[:keep_count].sort().values
+            prune_basic_block(block, keep)
+        widths.append(block.conv1.out_channels)
+    return widths
+
+def _forward_latency_ms(model, inputs, repeats=20, warmup=3):
+    model.eval()
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start_time = time.perf_counter()
+            model(inputs)
+            if i >= warmup:
+                times.append(time.perf_counter() - start_time)
+    return 1000 * float(np.median(times))
+
+def prune_to_target(model, train_loader, test_loader, target_latency_ms=None, target_gflops=None, step_ratio=0.2,
+                    max_steps=8, finetune_epochs=1, lr=0.0001, latency_batch_size=1, image_size=128, device='cpu',
+                    chart_path=None):
+    """Iteratively prune and fine-tune model until a CPU latency or FLOPs budget is met.
+
+    Each step removes step_ratio of the remaining inner channels of every
+    residual block (prune_backbone), then fine-tunes for finetune_epochs.
+    Latency is the median batch-of-latency_batch_size forward time on the
+    current threads. Returns the pruned model and one row per step (step 0 is
+    the unpruned model) with accuracy, F1, latency, GFLOPs and parameters,
+    optionally plotted as an accuracy-versus-latency curve.
+    """
+    if target_latency_ms is None and target_gflops is None:
+        raise ValueError("Set target_latency_ms and/or target_gflops")
+    from sklearn.metrics import f1_score
+    device = torch.device(device)
+    model = model.to(device)
+    criterion = nn.CrossEntropyLoss(label_smoothing=0.1)
+    inputs = torch.randn(latency_batch_size, 3, image_size, image_size, device=device)
+
+    def measure(step, widths):
+        preds, labels, _ = predict(model, model, test_loader, criterion, device)
+        row = {
+            'step': step,
+            'accuracy': 100 * (preds == labels).mean(),
+            'f1': f1_score(labels, preds, average='macro'),
+            'latency_ms': _forward_latency_ms(model, inputs),
+            'gflops': _count_flops(model, inputs[:1]) / 1e9,
+            'params_m': sum(p.numel() for p in model.parameters()) / 1e6,
+            'block_widths': widths,
+        }
+        print(f"Step {step}: accuracy {row['accuracy']:.2f}%, F1 {row['f1']:.4f}, latency {row['latency_ms']:.2f} ms, "
+              f"{row['gflops']:.3f} GFLOPs, {row['params_m']:.2f}M params")
+        return row
+
+    def meets_target(row):
+        return ((target_latency_ms is None or row['latency_ms'] <= target_latency_ms) and
+                (target_gflops is None or row['gflops'] <= target_gflops))
+
+    curve = [measure(0, [block.conv1.out_channels for block in _basic_blocks(model)])]
+    for step in range(1, max_steps + 1):
+        if meets_target(curve[-1]):
+            break
+        widths = prune_backbone(model, step_ratio)
+        # Parameters were replaced, so the optimizer is rebuilt after every pruning step
+        optimizer = optim.Adam([p for p in model.parameters() if p.requires_grad], lr=lr)
+        for epoch in range(finetune_epochs):
+            train_one_epoch(model, model, train_loader, optimizer, criterion, device)
+        curve.append(measure(step, widths))
+
+    if not meets_target(curve[-1]):
+        print(f"Target not reached after {max_steps} pruning steps")
+
+    if chart_path is not None:
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(5, 4))
+        plt.plot([row['latency_ms'] for row in curve], [row['accuracy'] for row in curve], marker='o', label='pruned')
+        plt.scatter([curve[0]['latency_ms']], [curve[0]['accuracy']], color='red', zorder=3, label='unpruned')
+        plt.xlabel(f'CPU latency, batch {latency_batch_size} (ms)')
+        plt.ylabel('Test accuracy (%)')
+        plt.title(f'{type(model).__name__} channel pruning')
+        plt.legend()
+        plt.grid(True)
+        plt.savefig(chart_path, bbox_inches='tight')
+        plt.close()
+    return model, curve
+
+if __name__ == "__main__":
+    train_dataset, test_dataset = mhist_datasets(annotations_file, img_dir)
+    pruned_model, pruning_curve = prune_to_target(
+        metrics['model'], make_train_loader(train_dataset, 16, num_workers=2),
+        DataLoader(test_dataset, batch_size=16, num_workers=2), target_gflops=0.3,
+        chart_path=os.path.join(data_path, "pruning_curve.png"))
+    torch.save(pruned_model, os.path.join(data_path, "pruned_model.pt"))
+
+"""Per-sample vs batched augmentation"""
+
+def benchmark_batch_transforms(batch_sizes=(16, 64, 256), num_images=512, source_size=224, image_size=128, seed=0):
+    """Images/s of the per-image PIL transform chain vs BatchTransform on the collated uint8 batch.
+
+    Both paths do the same work: resize source_size -> image_size, flips,
+    90-degree rotations, brightness/contrast/saturation jitter and
+    normalization. Decoding is excluded: the per-image path starts from PIL
+    images, the batched path from the stacked uint8 tensors they came from.
+    """
+    rng = np.random.default_rng(seed)
+    arrays = rng.integers(0, 256, size=(num_images, source_size, source_size, 3), dtype=np.uint8)
+    pil_images = [Image.fromarray(array) for array in arrays]
+    uint8_images = torch.from_numpy(arrays).permute(0, 3, 1, 2)
+
+    per_image = transforms.Compose([
+        transforms.Resize((image_size, image_size)),
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomVerticalFlip(),
+        transforms.RandomChoice([transforms.RandomRotation((angle, angle)) for angle in (0, 90, 180, 270)]),
+        transforms.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=MHIST_MEAN, std=MHIST_STD)
+    ])
+    batched = mhist_batch_transform(augment=True, size=image_size).train()
+
+    rows = []
+    for batch_size in batch_sizes:
+        start_time = time.perf_counter()
+        for start in range(0, num_images, batch_size):
+            torch.stack([per_image(image) for image in pil_images[start:start + batch_size]])
+        per_image_rate = num_images / (time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        for start in range(0, num_images, batch_size):
+            # Collation is part of the batched path: stack the uint8 items first
+            batched(torch.stack(list(uint8_images[start:start + batch_size])))
+        batched_rate = num_images / (time.perf_counter() - start_time)
+
+        rows.append({'batch_size': batch_size, 'per_image_per_sec': per_image_rate, 'batched_per_sec': batched_rate,
+                     'speedup': batched_rate / per_image_rate})
+        print(f"batch {batch_size:>4}: per-image {per_image_rate:7.0f} img/s, batched {batched_rate:7.0f} img/s "
+              f"({rows[-1]['speedup']:.1f}x)")
+    return rows
+
+if __name__ == "__main__":
+    augmentation_rows = benchmark_batch_transforms()
+    metrics = train_hybrid_model(annotations_file, img_dir, packed_dir=os.path.join(data_path, "packed"),
+                                 batch_transform=mhist_batch_transform())
+
+"""Confidence-gated cascade"""
+
+def softmax_margin(probs):
+    """Top-1 minus top-2 class probability per row."""
+    top2 = probs.topk(2, dim=1).values
+    return top2[:, 0] - top2[:, 1]
+
+class CascadeClassifier(nn.Module):
+    """Run a cheap model first and escalate to an expensive one only for uncertain inputs.
+
+    An input is escalated when the cheap model's softmax margin is below
+    threshold. cheap_size optionally downsamples the input for the cheap model
+    only. The output is log-probabilities, so argmax and softmax behave as for
+    a plain classifier (e.g. inside MHISTInferenceServer or predict); the
+    escalation mask of the last call is kept in last_escalated.
+    """
+    def __init__(self, cheap_model, expensive_model, threshold, cheap_size=None):
+        super().__init__()
+        self.cheap_model = cheap_model
+        self.expensive_model = expensive_model
+        self.threshold = threshold
+        self.cheap_size = cheap_size
+        self.last_escalated = None
+
+    def cheap_forward(self, x):
+        if self.cheap_size is not None and x.shape[-1] != self.cheap_size:
+            x = F.interpolate(x, size=(self.cheap_size, self.cheap_size), mode='bilinear', antialias=True,
+                              align_corners=False)
+        return self.cheap_model(x)
+
+    def forward(self, x):
+        probs = F.softmax(self.cheap_forward(x), dim=1)
+        escalated = softmax_margin(probs) < self.threshold
+        if escalated.any():
+            probs = probs.clone()
+            probs[escalated] = F.softmax(self.expensive_model(x[escalated]), dim=1).to(probs.dtype)
+        self.last_escalated = escalated
+        return probs.clamp_min(1e-12).log()
+
+def _collect_probs(forward, loader, device):
+    probs, labels, seconds = [], [], 0.0
+    with torch.no_grad():
+        for inputs, batch_labels in loader:
+            inputs = inputs.to(device)
+            start_time = time.perf_counter()
+            probs.append(F.softmax(forward(inputs), dim=1).cpu())
+            seconds += time.perf_counter() - start_time
+            labels.append(batch_labels)
+    probs, labels = torch.cat(probs), torch.cat(labels)
+    return probs, labels, 1000 * seconds / len(labels)
+
+def calibrate_cascade(cheap_model, expensive_model, loader, thresholds=None, cheap_size=None, max_accuracy_drop=0.5,
+                      image_size=128, device='cpu'):
+    """Sweep the escalation threshold of a cheap -> expensive cascade on one partition.
+
+    Both models run once over loader; every threshold is then evaluated from
+    the stored probabilities. Cost per image is the cheap model's cost plus
+    the escalation rate times the expensive model's, both in measured ms/image
+    (at the loader's batch size) and in GFLOPs. The chosen threshold is the one
+    with the lowest escalation rate whose accuracy is within max_accuracy_drop
+    points of the expensive model alone. Returns (rows, threshold).
+    """
+    from sklearn.metrics import f1_score
+    device = torch.device(device)
+    cascade = CascadeClassifier(cheap_model.to(device).eval(), expensive_model.to(device).eval(), 0.0, cheap_size)
+    cheap_probs, labels, cheap_ms = _collect_probs(cascade.cheap_forward, loader, device)
+    expensive_probs, _, expensive_ms = _collect_probs(cascade.expensive_model, loader, device)
+    inputs = torch.randn(1, 3, image_size, image_size, device=device)
+    with torch.no_grad():
+        cheap_gflops = _count_flops(cascade.cheap_forward, inputs) / 1e9
+        expensive_gflops = _count_flops(cascade.expensive_model, inputs) / 1e9
+
+    margins = softmax_margin(cheap_probs)
+    thresholds = np.linspace(0, 1, 21) if thresholds is None else thresholds
+    rows = []
+    for name, threshold in [('cheap only', 0.0)] + [('cascade', float(t)) for t in thresholds if t > 0] + [('expensive only', None)]:
+        escalated = torch.ones_like(margins, dtype=torch.bool) if threshold is None else margins < threshold
+        preds = torch.where(escalated, expensive_probs.argmax(1), cheap_probs.argmax(1)).numpy()
+        rate = escalated.float().mean().item()
+        rows.append({
+            'mode': name,
+            'threshold': threshold,
+            'escalation_rate': rate,
+            'accuracy': 100 * (preds == labels.numpy()).mean(),
+            'f1': f1_score(labels.numpy(), preds, average='macro'),
+            # Expensive-only skips the cheap model entirely
+            'ms_per_image': expensive_ms if threshold is None else cheap_ms + rate * expensive_ms,
+            'gflops_per_image': expensive_gflops if threshold is None else cheap_gflops + rate * expensive_gflops,
+        })
+
+    target = rows[-1]['accuracy'] - max_accuracy_drop
+    candidates = [row for row in rows[1:-1] if row['accuracy'] >= target]
+    chosen = min(candidates, key=lambda row: (row['escalation_rate'], -row['accuracy'])) if candidates else rows[-2]
+
+    print(f"{'mode':>14} {'thresh':>6} {'escalated':>9} {'acc %':>7} {'F1':>6} {'ms/img':>7} {'GFLOPs':>7}")
+    for row in rows:
+        threshold = '-' if row['threshold'] is None else f"{row['threshold']:.2f}"
+        marker = ' <' if row is chosen else ''
+        print(f"{row['mode']:>14} {threshold:>6} {100 * row['escalation_rate']:>8.1f}% {row['accuracy']:>7.2f} "
+              f"{row['f1']:>6.4f} {row['ms_per_image']:>7.2f} {row['gflops_per_image']:>7.3f}{marker}")
+    return rows, chosen['threshold']
+
+def benchmark_cascade(cascade, loader, device='cpu'):
+    """End-to-end ms/image, escalation rate and accuracy of a calibrated CascadeClassifier."""
+    from sklearn.metrics import f1_score
+    device = torch.device(device)
+    cascade = cascade.to(device).eval()
+    escalated, preds, labels, seconds = 0, [], [], 0.0
+    with torch.no_grad():
+        for inputs, batch_labels in loader:
+            inputs = inputs.to(device)
+            start_time = time.perf_counter()
+            preds.append(cascade(inputs).argmax(1).cpu())
+            seconds += time.perf_counter() - start_time
+            escalated += cascade.last_escalated.sum().item()
+            labels.append(batch_labels)
+    preds, labels = torch.cat(preds).numpy(), torch.cat(labels).numpy()
+    result = {'ms_per_image': 1000 * seconds / len(labels), 'escalation_rate': escalated / len(labels),
+              'accuracy': 100 * (preds == labels).mean(), 'f1': f1_score(labels, preds, average='macro')}
+    print(f"Cascade (threshold {cascade.threshold:.2f}): {result['ms_per_image']:.2f} ms/image, "
+          f"{100 * result['escalation_rate']:.1f}% escalated, accuracy {result['accuracy']:.2f}%, F1 {result['f1']:.4f}")
+    return result
+
+if __name__ == "__main__":
+    baseline_metrics = train_baseline_model(annotations_file, img_dir)
+    hybrid_metrics = train_hybrid_model(annotations_file, img_dir)
+    # MHIST only has train/test partitions, so the threshold is calibrated on test as requested
+    _, test_dataset = mhist_datasets(annotations_file, img_dir)
+    test_loader = DataLoader(test_dataset, batch_size=16, num_workers=2)
+    for cheap_size in [None, 96]:
+        cascade_rows, cascade_threshold = calibrate_cascade(baseline_metrics['model'], hybrid_metrics['model'],
+                                                            test_loader, cheap_size=cheap_size)
+        cascade = CascadeClassifier(baseline_metrics['model'], hybrid_metrics['model'], cascade_threshold, cheap_size)
+        cascade_result = benchmark_cascade(cascade, test_loader)
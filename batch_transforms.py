@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Batch-level image transforms shared by the ProjectB notebooks.
+
+Usage:
+    augment = BatchTransform(mean, std, hflip=0.5, vflip=0.5, rot90=True, brightness=0.1)
+    images = augment(uint8_batch)   # (B, C, H, W) uint8 -> normalized float
+    augment.eval()                  # resize + normalize only
+
+Datasets only decode (and, for variable-size images, resize) to uint8; the
+default collate stacks the batch and everything else runs here as a handful of
+vectorized tensor ops per batch instead of a Python transform chain per image.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class BatchTransform(nn.Module):
+    """Resize, random flips / 90-degree rotations, color jitter and normalization on a whole batch.
+
+    Every augmentation is drawn independently per sample. Augmentations only
+    run in training mode, so the same module gives the deterministic eval
+    transform after .eval(). Jitter factors are drawn uniformly from
+    [1 - x, 1 + x] like transforms.ColorJitter; rot90 needs square images.
+    Works on whatever device the batch is on.
+    """
+
+    def __init__(self, mean, std, size=None, hflip=0.0, vflip=0.0, rot90=False, brightness=0.0, contrast=0.0,
+                 saturation=0.0):
+        super().__init__()
+        self.size = (size, size) if isinstance(size, int) else size
+        self.hflip = hflip
+        self.vflip = vflip
+        self.rot90 = rot90
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1), persistent=False)
+
+    def _factors(self, amount, batch_size, device):
+        return 1 + amount * (2 * torch.rand(batch_size, 1, 1, 1, device=device) - 1)
+
+    def _dihedral(self, x):
+        """Random flips and 90-degree turns, one gather per distinct combination in the batch."""
+        batch_size, device = x.shape[0], x.device
+        codes = torch.zeros(batch_size, dtype=torch.long, device=device)
+        if self.hflip:
+            codes += (torch.rand(batch_size, device=device) < self.hflip).long()
+        if self.vflip:
+            codes += 2 * (torch.rand(batch_size, device=device) < self.vflip).long()
+        if self.rot90:
+            codes += 4 * torch.randint(4, (batch_size,), device=device)
+        for code in codes.unique().tolist():
+            if code == 0:
+                continue
+            selected = (codes == code).nonzero().squeeze(1)
+            y = x.index_select(0, selected)
+            if code & 1:
+                y = y.flip(-1)
+            if code & 2:
+                y = y.flip(-2)
+            if code >> 2:
+                y = torch.rot90(y, code >> 2, dims=(-2, -1))
+            x.index_copy_(0, selected, y)
+        return x
+
+    def _color_jitter(self, x):
+        """Brightness, contrast and saturation folded into one per-sample affine map of
+        (pixel, pixel luma, image mean luma); clamped once at the end."""
+        batch_size, device = x.shape[0], x.device
+        ones = torch.ones(batch_size, 1, 1, 1, device=device)
+        b = self._factors(self.brightness, batch_size, device) if self.brightness else ones
+        c = self._factors(self.contrast, batch_size, device) if self.contrast else ones
+        s = self._factors(self.saturation, batch_size, device) if self.saturation else ones
+
+        x_coef = b * c * s
+        if self.contrast or self.saturation:
+            luma = (x * _GRAY_WEIGHTS.to(device)).sum(1, keepdim=True)
+            offset = luma * ((1 - s) * c * b)
+            if self.contrast:
+                offset += (1 - c) * b * luma.mean(dim=(-2, -1), keepdim=True)
+            x = x.mul_(x_coef).add_(offset)
+        else:
+            x = x.mul_(x_coef)
+        return x.clamp_(0, 1)
+
+    def forward(self, images):
+        x = images
+        if self.size is not None and tuple(x.shape[-2:]) != tuple(self.size):
+            # CPU resizes uint8 directly, which is several times cheaper than resizing floats
+            if x.dtype == torch.uint8 and x.device.type != 'cpu':
+                x = x.float()
+            x = F.interpolate(x, size=self.size, mode='bilinear', antialias=True, align_corners=False)
+
+        if self.training and (self.hflip or self.vflip or self.rot90):
+            # Geometric ops are exact, so they run before the float conversion on the smaller dtype
+            x = self._dihedral(x.clone() if x is images else x)
+
+        x = x.float() if x.dtype != torch.float32 else (x.clone() if x is images else x)
+        if images.dtype == torch.uint8:
+            x = x.div_(255)
+        if self.training and (self.brightness or self.contrast or self.saturation):
+            x = self._color_jitter(x)
+        return x.sub_(self.mean).div_(self.std)
+
+
+# ITU-R 601 luma weights, as used by torchvision's rgb_to_grayscale
+_GRAY_WEIGHTS = torch.tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
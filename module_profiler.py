@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Per-module latency, memory and FLOPs profiling shared by the ProjectB notebooks.
+
+Usage:
+    with ModuleProfiler(model) as prof:
+        loss = model(x).sum()
+        loss.backward()
+    prof.print_table()
+    prof.export_chrome_trace("trace.json")
+
+Hooks are only installed inside the with-block, so a model that is not being
+profiled runs without any extra overhead.
+"""
+
+import json
+import time
+from collections import defaultdict
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+
+def _tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            yield from _tensors(item)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            yield from _tensors(item)
+
+
+class ModuleProfiler:
+    """Records wall time, call counts, allocated bytes and measured FLOPs for every submodule.
+
+    Forward time is taken between forward pre/post hooks. Backward time runs from
+    the moment the gradient w.r.t. a module's output arrives until the gradient
+    w.r.t. its inputs is ready, using tensor hooks (module backward hooks clash
+    with the in-place ReLUs in ResNet). Allocated bytes are the CUDA allocator
+    delta on GPU and the size of the produced outputs on CPU. FLOPs come from
+    FlopCounterMode and cover every matmul/conv issued while the module is active,
+    including functional code such as the Mamba scan, in forward and backward.
+    Times are inclusive of child modules; backward times also include any work
+    the autograd engine schedules in between, and modules whose inputs do not
+    require grad (e.g. the root called on raw images) report no backward time.
+    """
+
+    def __init__(self, model, record_backward=True, record_flops=True):
+        self.model = model
+        self.record_backward = record_backward
+        self.record_flops = record_flops
+        self.names = {module: name or type(model).__name__ for name, module in model.named_modules()}
+        self.stats = defaultdict(lambda: defaultdict(float))
+        self.events = []
+        self.flops = {}
+        self._handles = []
+        self._starts = defaultdict(list)
+
+    def _now_us(self):
+        return (time.perf_counter_ns() - self._t0) / 1000
+
+    def _pre_forward(self, module, inputs):
+        memory = torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+        self._starts[module].append((self._now_us(), memory))
+        if self.record_backward and torch.is_grad_enabled():
+            call = {'start': None}
+            for tensor in _tensors(inputs):
+                if tensor.requires_grad:
+                    tensor.register_hook(lambda grad, module=module, call=call: self._end_backward(module, call))
+            self._starts[module].append(call)
+
+    def _post_forward(self, module, inputs, outputs):
+        call = self._starts[module].pop() if self.record_backward and torch.is_grad_enabled() else None
+        start, memory = self._starts[module].pop()
+        end = self._now_us()
+
+        outputs_list = list(_tensors(outputs))
+        if outputs_list and outputs_list[0].is_cuda:
+            allocated = torch.cuda.memory_allocated() - memory
+        else:
+            allocated = sum(t.numel() * t.element_size() for t in outputs_list)
+
+        name = self.names[module]
+        stats = self.stats[name]
+        stats['calls'] += 1
+        stats['forward_us'] += end - start
+        stats['allocated_bytes'] += allocated
+        self.events.append({'name': name, 'cat': 'forward', 'ph': 'X', 'ts': start, 'dur': end - start,
+                            'pid': 0, 'tid': 0, 'args': {'type': type(module).__name__}})
+
+        if call is not None:
+            for tensor in outputs_list:
+                if tensor.requires_grad:
+                    tensor.register_hook(lambda grad, call=call: self._start_backward(call))
+
+    def _start_backward(self, call):
+        if call['start'] is None:
+            call['start'] = self._now_us()
+
+    def _end_backward(self, module, call):
+        if call['start'] is None or call.get('done'):
+            return
+        call['done'] = True
+        end = self._now_us()
+        name = self.names[module]
+        self.stats[name]['backward_us'] += end - call['start']
+        self.events.append({'name': name, 'cat': 'backward', 'ph': 'X', 'ts': call['start'],
+                            'dur': end - call['start'], 'pid': 0, 'tid': 1,
+                            'args': {'type': type(module).__name__}})
+
+    def __enter__(self):
+        self._t0 = time.perf_counter_ns()
+        for module in self.names:
+            self._handles.append(module.register_forward_pre_hook(self._pre_forward))
+            self._handles.append(module.register_forward_hook(self._post_forward))
+        if self.record_flops:
+            self._flop_counter = FlopCounterMode(display=False)
+            self._flop_counter.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        if self.record_flops:
+            self._flop_counter.__exit__(*exc)
+            counts = self._flop_counter.get_flop_counts()
+            root = type(self.model).__name__
+            for module, name in self.names.items():
+                key = root if module is self.model else f"{root}.{name}"
+                self.flops[name] = sum(counts.get(key, {}).values())
+
+    def summary(self, sort_by='forward_ms'):
+        """One row per module with totals across all calls."""
+        rows = []
+        types = {name: type(module).__name__ for module, name in self.names.items()}
+        for name, stats in self.stats.items():
+            calls = int(stats['calls'])
+            rows.append({
+                'module': name,
+                'type': types[name],
+                'calls': calls,
+                'forward_ms': stats['forward_us'] / 1000,
+                'forward_ms_per_call': stats['forward_us'] / 1000 / calls,
+                'backward_ms': stats['backward_us'] / 1000,
+                'allocated_mb': stats['allocated_bytes'] / 2**20,
+                'gflops': self.flops.get(name, 0) / 1e9,
+            })
+        return sorted(rows, key=lambda row: row[sort_by], reverse=True)
+
+    def print_table(self, sort_by='forward_ms', top=20):
+        rows = self.summary(sort_by)[:top]
+        width = max([len(row['module']) for row in rows] + [6])
+        type_width = max([len(row['type']) for row in rows] + [4])
+        print(f"{'module':<{width}}  {'type':<{type_width}} {'calls':>6} {'fwd ms':>9} {'bwd ms':>9} "
+              f"{'alloc MB':>9} {'GFLOPs':>8}")
+        for row in rows:
+            print(f"{row['module']:<{width}}  {row['type']:<{type_width}} {row['calls']:>6} {row['forward_ms']:>9.2f} "
+                  f"{row['backward_ms']:>9.2f} {row['allocated_mb']:>9.2f} {row['gflops']:>8.3f}")
+
+    def export_chrome_trace(self, path):
+        """Write the recorded events in Chrome trace format (chrome://tracing, Perfetto)."""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)